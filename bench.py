@@ -0,0 +1,138 @@
+"""Замеры производительности обработчиков на большой базе.
+
+Запуск: python bench.py
+Бот и Telegram не нужны: база создаётся во временной папке,
+сообщения и колбэки заменяются заглушками.
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import tracemalloc
+
+GROUPS_COUNT = 50_000
+REPEATS = 50
+CACHED_GROUPS_COUNT = 100_000
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+os.chdir(tempfile.mkdtemp(prefix="tgbot_bench_"))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR")
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+
+class FakeMessage:
+    def __init__(self, text: str = ""):
+        self.text = text
+
+    async def edit_text(self, *args, **kwargs):
+        pass
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeCallback:
+    def __init__(self, data: str):
+        self.data = data
+        self.message = FakeMessage()
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeState:
+    async def clear(self):
+        pass
+
+    async def set_state(self, state=None):
+        pass
+
+    async def get_data(self):
+        return {}
+
+
+def fill_database():
+    cursor = main.db.conn.cursor()
+    cursor.executemany(
+        'INSERT INTO groups (link, tags) VALUES (?, ?)',
+        ((f"https://t.me/bench_group_{i}", "bench") for i in range(GROUPS_COUNT))
+    )
+    cursor.executemany(
+        'INSERT INTO templates (name, content) VALUES (?, ?)',
+        ((f"template {i}", f"content {i}") for i in range(100))
+    )
+    main.db.conn.commit()
+
+
+def legacy_lookup():
+    # Прежний путь: загрузка всей таблицы и поиск в списке
+    groups = main.db.get_groups()
+    group = groups[GROUPS_COUNT // 2]
+    return len(groups), group
+
+
+async def measure(name: str, make_call):
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        await make_call()
+    elapsed = (time.perf_counter() - started) / REPEATS * 1000
+    print(f"{name:<40} {elapsed:9.3f} мс")
+
+
+def measure_memory(name: str, build):
+    tracemalloc.start()
+    rows = [(i, f"https://t.me/bench_group_{i}", "bench", None) for i in range(CACHED_GROUPS_COUNT)]
+    before = tracemalloc.get_traced_memory()[0]
+    cache = build(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cache, rows
+    print(f"{name:<40} {(after - before) / 2**20:9.2f} МБ")
+
+
+def run_memory():
+    print(f"\nПамять на {CACHED_GROUPS_COUNT} групп в кэше (без учёта самих строк):\n")
+    measure_memory(
+        "dict на строку",
+        lambda rows: [{'id': row[0], 'link': row[1], 'tags': row[2], 'timezone': row[3]} for row in rows]
+    )
+    measure_memory("Group (NamedTuple)", lambda rows: [main.Group._make(row) for row in rows])
+
+
+async def run():
+    fill_database()
+    print(f"Групп в базе: {GROUPS_COUNT}, повторов: {REPEATS}\n")
+
+    async def legacy():
+        legacy_lookup()
+
+    await measure("get_groups() + поиск в списке", legacy)
+    await measure("show_stats", lambda: main.show_stats(FakeCallback("show_stats")))
+    await measure("use_template", lambda: main.use_template(FakeCallback("use_template_50")))
+    await measure("templates_menu", lambda: main.templates_menu(FakeCallback("templates_menu")))
+    await measure(
+        "confirm_remove_template",
+        lambda: main.confirm_remove_template(FakeCallback("ask_remove_template_50"))
+    )
+    await measure("view_groups (первая страница)", lambda: main.view_groups(FakeCallback("view_groups")))
+    await measure(
+        "groups_page (середина списка)",
+        lambda: main.groups_page(FakeCallback(f"gpage:groups:n:{GROUPS_COUNT // 2}"), FakeState())
+    )
+    # ID за пределами списка: замер поиска без перехода
+    await measure(
+        "jump_to_process (ID)",
+        lambda: main.jump_to_process(FakeMessage(str(GROUPS_COUNT + 1)), FakeState())
+    )
+    await measure(
+        "jump_to_process (начало ссылки)",
+        lambda: main.jump_to_process(FakeMessage(f"bench_group_{GROUPS_COUNT - 1}"), FakeState())
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
+    run_memory()
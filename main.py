@@ -1,26 +1,46 @@
 import os
 import sys
+import io
 import json
+import re
 import logging
 import asyncio
+import hashlib
+import heapq
+import socket
 import sqlite3
-from datetime import datetime, time
-from typing import List, Dict, Optional, Set
+from collections import OrderedDict, deque
+import threading
+import uuid
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from typing import Any, Awaitable, Callable, List, Dict, Optional, Set, Tuple, Iterable, Iterator, NamedTuple
 from urllib.parse import urlparse
 
 import pytz
 import socks
-from dateparser import parse
+from aiohttp import web
+from dateparser import DateDataParser
 from dotenv import load_dotenv
 from telethon import TelegramClient
-from telethon.errors import FloodWaitError
-from aiogram import Bot, Dispatcher, types, F
+from telethon.errors import (
+    ChannelPrivateError, FloodWaitError, SlowModeWaitError, UsernameInvalidError, UsernameNotOccupiedError
+)
+from telethon.tl.functions.channels import GetForumTopicsByIDRequest, GetFullChannelRequest
+from telethon.tl.types import Channel, Chat, InputPeerChannel, User
+from telethon.utils import get_peer_id
+from telethon.extensions import html as telethon_html
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.flags import get_flag
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.client.default import DefaultBotProperties
 
 # Настройка event loop для Windows
@@ -50,9 +70,63 @@ PHONE_NUMBER = os.getenv("PHONE_NUMBER")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TIMEZONE = os.getenv("TIMEZONE", "Europe/Moscow")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+# Что делать с пропущенными отправками (бот был выключен или занят):
+# late - отправить с опозданием в пределах CATCHUP_GRACE_MINUTES, иначе пропустить
+# skip - всегда пропускать
+# coalesce - отправить один раз, сколько бы срабатываний ни было пропущено
+CATCHUP_POLICY = os.getenv("CATCHUP_POLICY", "late")
+CATCHUP_GRACE_MINUTES = int(os.getenv("CATCHUP_GRACE_MINUTES", "30"))
+# Аренда лидерства: планировщик работает только в одном экземпляре бота
+LEASE_TTL = int(os.getenv("LEASE_TTL", "30"))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# За сколько минут до запланированной отправки готовить адресатов и медиа
+PREWARM_MINUTES = int(os.getenv("PREWARM_MINUTES", "10"))
+# Через сколько часов сведения о группе (тип, права, медленный режим) устаревают
+METADATA_REFRESH_HOURS = int(os.getenv("METADATA_REFRESH_HOURS", "24"))
+# Получение обновлений: polling или webhook. Если webhook не удалось
+# включить, бот работает через polling
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # публичный адрес бота, https://...
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram передаёт в заголовке каждого запроса. По умолчанию
+# выводится из токена, чтобы у всех экземпляров бота он совпадал
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+# Порт веб-сервера (webhook и /health); PORT задают хостинги с процессом web
+WEB_PORT = int(os.getenv("WEB_PORT") or os.getenv("PORT") or "8080")
+# Срок актуальности ручной рассылки в минутах: не доставленное за это время
+# считается устаревшим и не отправляется. 0 - без ограничения
+BROADCAST_TTL_MINUTES = int(os.getenv("BROADCAST_TTL_MINUTES", "0"))
 
 # Rate limiter для защиты от спама
 send_semaphore = asyncio.Semaphore(1)
+# Минимальная задержка между отправками, секунд
+SEND_INTERVAL = 1.2
+# Пауза между разрешениями новых ссылок при подготовке рассылки, секунд
+RESOLVE_INTERVAL = 1.0
+# Сколько разрешённых адресатов держать в памяти; давно не использованные вытесняются
+ENTITY_CACHE_SIZE = 10_000
+# Число одновременных отправителей; общий темп всё равно задаёт send_semaphore
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "1"))
+# Тяжёлые обработчики (рассылка, предпросмотр медиа): сколько выполняется
+# одновременно и сколько может ждать в очереди
+HEAVY_WORKERS = 4
+HEAVY_QUEUE_LIMIT = 100
+# Как часто изменения состояний диалогов (FSM) записываются в базу, секунд
+FSM_FLUSH_INTERVAL = 1.0
+# Как часто проверяются записи других экземпляров бота для кэшей клавиатур, секунд
+TABLE_CHANGES_INTERVAL = 5.0
+# Размер пачки строк для миграций, чтобы не держать базу заблокированной
+MIGRATION_BATCH_SIZE = 1000
+# Максимальный размер файла со списком групп для импорта, байт
+IMPORT_MAX_FILE_SIZE = 5 * 1024 * 1024
+# Сколько групп проверяется за один проход фонового обновления сведений
+METADATA_BATCH_SIZE = 50
+# Проверка перед рассылкой берёт из group_health сведения не старше этого, минут
+PREFLIGHT_FRESH_MINUTES = 60
+# Размер страницы в списках групп и запланированных постов
+GROUPS_PAGE_SIZE = 20
+SCHEDULE_PAGE_SIZE = 5
 
 # Подключение через прокси (с fallback на прямое подключение)
 
@@ -96,13 +170,182 @@ async def create_client_with_proxy(api_id, api_hash, session_name="session_name"
     logger.warning("Прокси не работают, пробуем подключиться без них")
     return TelegramClient(session_name, api_id, api_hash)
 
+class SQLiteStorage(BaseStorage):
+    # Состояния диалогов FSM в таблице fsm_states базы бота, поэтому
+    # незаконченный диалог переживает перезапуск и виден другим экземплярам.
+    # Чтение идёт из кэша в памяти, запись сразу попадает в кэш, а в базу -
+    # одной транзакцией раз в flush_interval секунд и при остановке бота.
+    # Не чаще того же интервала сверяется счётчик изменений fsm_states: если
+    # таблицу изменило другое соединение, чистые записи кэша сбрасываются.
+
+    def __init__(self, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._cache: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._dirty: Set[str] = set()
+        self._version: Optional[int] = None
+        self._checked_at = float('-inf')
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _sync(self, version: int):
+        if version != self._version:
+            self._version = version
+            self._cache = {k: v for k, v in self._cache.items() if k in self._dirty}
+
+    def _get(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        now = asyncio.get_running_loop().time()
+        if now - self._checked_at >= self.flush_interval:
+            self._checked_at = now
+            self._sync(db.get_change_version('fsm_states'))
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            record = db.get_fsm_record(storage_key) or (None, {})
+            self._cache[storage_key] = record
+        return record
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        storage_key = self.key_builder.build(key)
+        self._cache[storage_key] = (state, data)
+        self._dirty.add(storage_key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        records = [(key, *self._cache.get(key, (None, {}))) for key in self._dirty]
+        try:
+            before, after = db.save_fsm_records(records)
+        except sqlite3.Error as e:
+            # Записи остаются в очереди и уйдут со следующей пачкой
+            logger.error(f"Ошибка сохранения состояний диалогов: {e}")
+            return
+        self._dirty.clear()
+        for key, state, data in records:
+            if state is None and not data:
+                self._cache.pop(key, None)
+        # Чужие записи до нашей сбрасывают кэш, наша собственная - нет
+        self._sync(before)
+        self._version = after
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._get(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = self._get(key)
+        self._put(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._get(key)[1].copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self.flush()
+
+class HeavyTaskPool:
+    # Ограниченный пул для долгих обработчиков. Одновременно выполняется не
+    # больше workers задач, а задачи одного пользователя - строго по очереди,
+    # в порядке поступления, поэтому двойное нажатие не запустит их параллельно.
+
+    def __init__(self, workers: int = HEAVY_WORKERS, limit: int = HEAVY_QUEUE_LIMIT):
+        self.limit = limit
+        self.pending = 0
+        self._semaphore = asyncio.Semaphore(workers)
+        self._queues: Dict[int, deque] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def submit(self, user_id: int, job: Callable[[], Awaitable[Any]]) -> bool:
+        if self.pending >= self.limit:
+            return False
+        self.pending += 1
+        queue = self._queues.get(user_id)
+        if queue is not None:
+            queue.append(job)
+            return True
+        self._queues[user_id] = deque([job])
+        task = asyncio.create_task(self._drain(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _drain(self, user_id: int):
+        queue = self._queues[user_id]
+        try:
+            while queue:
+                try:
+                    async with self._semaphore:
+                        await queue[0]()
+                except Exception as e:
+                    logger.error(f"Ошибка в фоновом обработчике пользователя {user_id}: {e}")
+                finally:
+                    queue.popleft()
+                    self.pending -= 1
+        finally:
+            del self._queues[user_id]
+
+class HeavyHandlerMiddleware(BaseMiddleware):
+    # Обработчики с флагом heavy уходят в пул. Цикл опроса aiogram и так
+    # обрабатывает каждое обновление отдельной задачей; пул нужен, чтобы
+    # ограничить число одновременных тяжёлых обработчиков и выполнять их
+    # для одного пользователя по очереди. Ошибки из пула передаются в
+    # обработчики dp.errors так же, как это делает ErrorsMiddleware.
+
+    def __init__(self, pool: HeavyTaskPool, router: Dispatcher):
+        self.pool = pool
+        self.router = router
+
+    async def _run(self, handler, event: types.TelegramObject, data: Dict[str, Any]):
+        try:
+            await handler(event, data)
+        except Exception as e:
+            response = await self.router.propagate_event(
+                update_type="error",
+                event=types.ErrorEvent(update=data["event_update"], exception=e),
+                **data,
+            )
+            if response is UNHANDLED:
+                raise
+
+    async def __call__(self, handler, event: types.TelegramObject, data: Dict[str, Any]) -> Any:
+        if not get_flag(data, "heavy"):
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        if not self.pool.submit(user.id if user else 0, lambda: self._run(handler, event, data)):
+            logger.warning("Очередь тяжёлых обработчиков переполнена")
+            if isinstance(event, types.CallbackQuery):
+                await event.answer("⏳ Бот занят, попробуйте позже", show_alert=True)
+        return None
+
+# Фоновые задачи обработчиков (итог рассылки, пробный прогон). Ссылки
+# держатся до завершения, иначе задачу может собрать сборщик мусора
+background_tasks: Set[asyncio.Task] = set()
+
+def run_in_background(coro: Awaitable[Any]) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # Инициализация клиентов
-storage = MemoryStorage()
+storage = SQLiteStorage()
+heavy_pool = HeavyTaskPool()
 bot = Bot(
     token=BOT_TOKEN,
     default=DefaultBotProperties(parse_mode="HTML")
 )
 dp = Dispatcher(storage=storage, close_old_connections=True, ignore_old_updates=True)
+dp.message.middleware(HeavyHandlerMiddleware(heavy_pool, dp))
+dp.callback_query.middleware(HeavyHandlerMiddleware(heavy_pool, dp))
 client = None  # будет создан в main()
 
 
@@ -110,7 +353,8 @@ client = None  # будет создан в main()
 # Состояния бота
 class Form(StatesGroup):
     add_group = State()
-    remove_group = State()
+    jump_to = State()
+    import_groups = State()
     set_text = State()
     set_time = State()
     add_template = State()
@@ -121,71 +365,397 @@ class Form(StatesGroup):
     add_schedule = State()
     remove_schedule = State()
     add_media = State()  # Новое состояние для загрузки медиа
+    set_timezone = State()
+
+# Записи, возвращаемые Database: компактнее словарей и с доступом по атрибутам
+class Group(NamedTuple):
+    id: int
+    link: str
+    tags: str = ''
+    # Часовой пояс сегмента; None - общий TIMEZONE
+    timezone: Optional[str] = None
+
+class Template(NamedTuple):
+    id: int
+    name: str
+    content: str
+
+class ScheduledPost(NamedTuple):
+    id: int
+    text: str
+    send_time: str
+    groups: List[str]
+    media_type: Optional[str] = None
+    media_file_id: Optional[str] = None
+    is_active: bool = True
+    # Время в секундах UTC (epoch)
+    next_fire_at: Optional[float] = None
+    last_fired_at: Optional[float] = None
+    # Правило повтора в формате cron; None - разовая отправка
+    rule: Optional[str] = None
+    # Окно доставки: рассылка равномерно растягивается на столько секунд
+    window_seconds: Optional[int] = None
+    # Часовой пояс расписания; None - общий TIMEZONE
+    timezone: Optional[str] = None
+    # Срок актуальности после срабатывания, секунд; None - без ограничения
+    ttl_seconds: Optional[int] = None
+
+# Сведения о группе из Telegram (таблица group_health)
+class GroupHealth(NamedTuple):
+    group_id: int
+    title: Optional[str] = None
+    # channel, supergroup, group или user
+    peer_type: Optional[str] = None
+    members: Optional[int] = None
+    slow_mode_seconds: int = 0
+    # None - неизвестно (временная ошибка)
+    can_post: Optional[bool] = None
+    error: Optional[str] = None
+    checked_at: Optional[float] = None
+
+# Ссылки на группы хранятся в каноническом виде, чтобы одна группа не
+# попадала в базу несколько раз под разными написаниями
+TELEGRAM_HOSTS = ('t.me', 'telegram.me', 'telegram.dog')
+USERNAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+def normalize_group_link(raw: str) -> Optional[str]:
+    # @Foo, t.me/foo/, https://telegram.me/s/Foo и foo.t.me -> https://t.me/foo;
+    # t.me/joinchat/HASH -> https://t.me/+HASH (регистр хэша значим);
+    # t.me/c/123/45 -> https://t.me/c/123. None - это не ссылка на Telegram
+    link = raw.strip()
+    if link.startswith('@'):
+        link = f"https://t.me/{link[1:]}"
+    elif not re.match(r'^https?://', link, re.IGNORECASE):
+        link = f"https://{link}"
+    parsed = urlparse(link)
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    parts = [part for part in parsed.path.split('/') if part]
+    if host.endswith('.t.me'):
+        parts = [host[:-len('.t.me')]]
+    elif host not in TELEGRAM_HOSTS or not parts:
+        return None
+    first = parts[0]
+    if first == 'joinchat' and len(parts) > 1:
+        return f"https://t.me/+{parts[1]}"
+    if first.startswith('+') and len(first) > 1:
+        return f"https://t.me/{first}"
+    if first == 'c' and len(parts) > 1 and parts[1].isdigit():
+        return f"https://t.me/c/{parts[1]}"
+    if first == 's' and len(parts) > 1:
+        first = parts[1]
+    if not USERNAME.match(first):
+        return None
+    return f"https://t.me/{first.lower()}"
+
+# Теги группы хранятся через запятую без пробелов: "новости,важное"
+TAG_SEPARATOR = ','
+
+def split_tags(value: Optional[str]) -> List[str]:
+    tags = (tag.strip() for tag in (value or '').split(TAG_SEPARATOR))
+    return list(dict.fromkeys(tag for tag in tags if tag))
+
+def normalize_tags(value: Optional[str]) -> str:
+    # "новости, важное ,новости" -> "новости,важное"
+    return TAG_SEPARATOR.join(split_tags(value))
+
+def link_search_prefix(query: str) -> str:
+    # Начало канонической ссылки для поиска: "News", "@news", "t.me/news"
+    # -> "https://t.me/news"; регистр хэша приглашения "+HASH" сохраняется
+    query = query.strip()
+    if query.startswith('@') or '/' in query:
+        canonical = normalize_group_link(query)
+        if canonical:
+            return canonical
+    query = query.lstrip('@')
+    return f"https://t.me/{query if query.startswith('+') else query.lower()}"
 
 class Database:
     def __init__(self):
         self.conn = sqlite3.connect('bot_data.db', check_same_thread=False)
-        self.create_tables()
-    
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY,
-                link TEXT UNIQUE,
-                tags TEXT DEFAULT ''
+        # Версии таблиц для кэшей (клавиатуры): растут при каждой записи
+        self._table_versions: Dict[str, int] = {}
+        # Последние увиденные счётчики table_changes (записи из всех соединений)
+        self._seen_changes: Dict[str, int] = {}
+        self._migration_version = 0
+        # WAL: чтение не блокируется записью других экземпляров бота
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.migrate()
+        # Кэш настроек: обновляется при своей записи, а записи других
+        # экземпляров бота подхватывает sync_changes
+        self._settings: Dict[str, Optional[str]] = {}
+        self.load_settings()
+        self.sync_changes()
+
+    # Миграции схемы
+    def migrate(self):
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TEXT NOT NULL
             )
         ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS templates (
-                id INTEGER PRIMARY KEY,
-                name TEXT UNIQUE,
-                content TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS scheduled_posts (
-                id INTEGER PRIMARY KEY,
-                text TEXT,
-                send_time TEXT,
-                groups TEXT,
-                media_type TEXT,  -- 'photo', 'video', или NULL
-                media_file_id TEXT,  -- file_id медиафайла
-                is_active INTEGER DEFAULT 1
-            )
-        ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_groups_tags ON groups(tags)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_posts_time ON scheduled_posts(send_time)')
         self.conn.commit()
-    
+        current = self.get_schema_version()
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Применяю миграцию схемы #{version}: {migration.__name__}")
+            self._migration_version = version
+            migration(self)
+            if self.get_schema_version() < version:
+                raise RuntimeError(f"Миграция #{version} не записала версию схемы")
+
+    @contextmanager
+    def final_migration_step(self):
+        # Последний шаг миграции: номер версии записывается в той же транзакции,
+        # так что сбой не оставит версию без изменений схемы и наоборот.
+        # Предыдущие шаги миграции обязаны выдерживать повторный запуск.
+        with self.transaction() as cursor:
+            yield cursor
+            cursor.execute(
+                'INSERT INTO schema_version (version, applied_at) VALUES (?, ?)',
+                (self._migration_version, datetime.now(pytz.utc).isoformat())
+            )
+
+    def get_schema_version(self) -> int:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        return cursor.fetchone()[0]
+
+    @contextmanager
+    def transaction(self):
+        if self.conn.in_transaction:
+            self.conn.commit()
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+
+    def get_change_version(self, table: str) -> int:
+        # Счётчик записей в таблицу из всех соединений (см. create_change_triggers)
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT version FROM table_changes WHERE name = ?', (table,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def touch(self, table: str):
+        self._table_versions[table] = self._table_versions.get(table, 0) + 1
+
+    def get_table_version(self, table: str) -> int:
+        # Без обращения к базе: записи других экземпляров учитывает sync_changes
+        return self._table_versions.get(table, 0)
+
+    def sync_changes(self):
+        # Вырос счётчик в table_changes - таблицу кто-то изменил, поднимаем
+        # её локальную версию. Свои записи поднимут её лишний раз, это безвредно
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT name, version FROM table_changes')
+        for name, version in cursor.fetchall():
+            if self._seen_changes.get(name, version) != version:
+                self.touch(name)
+                if name == 'settings':
+                    self.load_settings()
+            self._seen_changes[name] = version
+
+    def get_columns(self, table: str) -> List[str]:
+        cursor = self.conn.cursor()
+        cursor.execute(f'PRAGMA table_info({table})')
+        return [row[1] for row in cursor.fetchall()]
+
     # Методы работы с группами
     def add_group(self, link: str, tags: str = ""):
         cursor = self.conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO groups (link, tags) VALUES (?, ?)', (link, tags))
+        cursor.execute('INSERT OR IGNORE INTO groups (link, tags) VALUES (?, ?)', (link, normalize_tags(tags)))
         self.conn.commit()
     
+    def add_groups(self, groups: Iterable[Tuple[str, str]]) -> int:
+        # Пакетная вставка одной транзакцией; возвращает число новых строк
+        with self.transaction() as cursor:
+            cursor.executemany(
+                'INSERT OR IGNORE INTO groups (link, tags) VALUES (?, ?)',
+                ((link, normalize_tags(tags)) for link, tags in groups)
+            )
+            return cursor.rowcount
+
+    def set_group_peer_id(self, link: str, peer_id: int, remove_duplicate: bool = True) -> Optional[str]:
+        # Запоминает id чата группы. Если этот чат уже есть в базе под другой
+        # ссылкой (например, приглашение и username), возвращается ссылка уже
+        # добавленной группы, а строка-дубликат удаляется (её теги переходят
+        # к группе), если не указано remove_duplicate=False
+        with self.transaction() as cursor:
+            cursor.execute('SELECT link, tags FROM groups WHERE peer_id = ? AND link != ?', (peer_id, link))
+            owner = cursor.fetchone()
+            if owner and not remove_duplicate:
+                return owner[0]
+            if owner:
+                cursor.execute('SELECT id, tags FROM groups WHERE link = ?', (link,))
+                duplicate = cursor.fetchone()
+                if duplicate:
+                    cursor.execute('UPDATE groups SET tags = ? WHERE link = ?',
+                                   (merge_tags(owner[1], duplicate[1]), owner[0]))
+                    cursor.execute('DELETE FROM groups WHERE id = ?', (duplicate[0],))
+                    cursor.execute('DELETE FROM group_health WHERE group_id = ?', (duplicate[0],))
+                    self.touch('group_health')
+                return owner[0]
+            cursor.execute('UPDATE groups SET peer_id = ? WHERE link = ?', (peer_id, link))
+            return None
+
     def remove_group(self, group_id: int):
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM groups WHERE id = ?', (group_id,))
+        cursor.execute('DELETE FROM group_health WHERE group_id = ?', (group_id,))
         self.conn.commit()
+        self.touch('group_health')
     
-    def get_groups(self, tag: Optional[str] = None) -> List[Dict]:
+    def get_groups(self, tag: Optional[str] = None) -> List[Group]:
+        cursor = self.conn.cursor()
+        if tag:
+            cursor.execute(
+                f'SELECT {self._GROUP_COLUMNS} FROM groups WHERE {self._TAG_CONDITION} ORDER BY id',
+                (self._tag_param(tag),)
+            )
+        else:
+            cursor.execute(f'SELECT {self._GROUP_COLUMNS} FROM groups ORDER BY id')
+        return [self._group_from_row(row) for row in cursor.fetchall()]
+
+    def iter_groups(self, tag: Optional[str] = None, batch_size: int = 500) -> Iterator[Group]:
+        # Постраничное чтение по ключу: в памяти не больше одной страницы
+        last_id = 0
+        while True:
+            cursor = self.conn.cursor()
+            if tag:
+                cursor.execute(
+                    f'SELECT {self._GROUP_COLUMNS} FROM groups WHERE id > ? AND {self._TAG_CONDITION} '
+                    f'ORDER BY id LIMIT ?',
+                    (last_id, self._tag_param(tag), batch_size)
+                )
+            else:
+                cursor.execute(
+                    f'SELECT {self._GROUP_COLUMNS} FROM groups WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, batch_size)
+                )
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._group_from_row(row)
+            last_id = rows[-1][0]
+
+    def get_group(self, group_id: int) -> Optional[Group]:
+        cursor = self.conn.cursor()
+        cursor.execute(f'SELECT {self._GROUP_COLUMNS} FROM groups WHERE id = ?', (group_id,))
+        row = cursor.fetchone()
+        return self._group_from_row(row) if row else None
+
+    def find_group_from_id(self, group_id: int, tag: Optional[str] = None) -> Optional[Group]:
+        # Группа с этим id или ближайшая следующая: поиск по первичному ключу
+        where, params = 'id >= ?', [group_id]
+        if tag:
+            where += f' AND {self._TAG_CONDITION}'
+            params.append(self._tag_param(tag))
+        cursor = self.conn.cursor()
+        cursor.execute(f'SELECT {self._GROUP_COLUMNS} FROM groups WHERE {where} ORDER BY id LIMIT 1', params)
+        row = cursor.fetchone()
+        return self._group_from_row(row) if row else None
+
+    def find_group_by_link(self, prefix: str, tag: Optional[str] = None) -> Optional[Group]:
+        # Первая по алфавиту группа, ссылка которой начинается с prefix:
+        # диапазон по уникальному индексу на link, без полного просмотра
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        where, params = 'link >= ? AND link < ?', [prefix, upper]
+        if tag:
+            where += f' AND {self._TAG_CONDITION}'
+            params.append(self._tag_param(tag))
+        cursor = self.conn.cursor()
+        cursor.execute(f'SELECT {self._GROUP_COLUMNS} FROM groups WHERE {where} ORDER BY link LIMIT 1', params)
+        row = cursor.fetchone()
+        return self._group_from_row(row) if row else None
+
+    def _page(self, table: str, columns: str, where: str, params: Iterable[Any], after_id: int,
+              before_id: Optional[int], limit: int) -> Tuple[List[tuple], bool]:
+        # Страница по ключу id: вперёд после after_id или назад перед before_id.
+        # Одна строка сверх limit показывает, есть ли данные дальше по направлению.
+        backward = before_id is not None
+        conditions = ['id < ?' if backward else 'id > ?']
+        if where:
+            conditions.append(where)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f'SELECT {columns} FROM {table} WHERE {" AND ".join(conditions)} '
+            f'ORDER BY id {"DESC" if backward else "ASC"} LIMIT ?',
+            (before_id if backward else after_id, *params, limit + 1)
+        )
+        rows = cursor.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, more
+
+    def get_groups_page(self, after_id: int = 0, before_id: Optional[int] = None, tag: Optional[str] = None,
+                        limit: int = GROUPS_PAGE_SIZE) -> Tuple[List[Group], bool]:
+        where, params = (self._TAG_CONDITION, (self._tag_param(tag),)) if tag else ('', ())
+        rows, more = self._page('groups', self._GROUP_COLUMNS, where, params, after_id, before_id, limit)
+        return [self._group_from_row(row) for row in rows], more
+
+    def count_groups(self, tag: Optional[str] = None) -> int:
+        cursor = self.conn.cursor()
+        if tag:
+            cursor.execute(f'SELECT COUNT(*) FROM groups WHERE {self._TAG_CONDITION}', (self._tag_param(tag),))
+        else:
+            cursor.execute('SELECT COUNT(*) FROM groups')
+        return cursor.fetchone()[0]
+
+    def has_groups(self) -> bool:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM groups)')
+        return bool(cursor.fetchone()[0])
+
+    def group_exists(self, link: str) -> bool:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM groups WHERE link = ?)', (link,))
+        return bool(cursor.fetchone()[0])
+
+    def set_groups_timezone(self, timezone: Optional[str], tag: Optional[str] = None) -> int:
         cursor = self.conn.cursor()
         if tag:
-            cursor.execute('SELECT * FROM groups WHERE tags LIKE ?', (f"%{tag}%",))
+            cursor.execute(
+                f'UPDATE groups SET timezone = ? WHERE {self._TAG_CONDITION}', (timezone, self._tag_param(tag))
+            )
         else:
-            cursor.execute('SELECT * FROM groups')
-        return [{'id': row[0], 'link': row[1], 'tags': row[2]} for row in cursor.fetchall()]
+            cursor.execute('UPDATE groups SET timezone = ?', (timezone,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def get_links_by_timezone(self) -> Dict[Optional[str], List[str]]:
+        segments: Dict[Optional[str], List[str]] = {}
+        for group in self.iter_groups():
+            segments.setdefault(group.timezone, []).append(group.link)
+        return segments
+
+    # Порядок столбцов совпадает с полями Group
+    _GROUP_COLUMNS = ', '.join(Group._fields)
+    # Совпадение тега целиком: ",новости,важное," содержит ",новости,", но не ",нов,"
+    _TAG_CONDITION = f"instr('{TAG_SEPARATOR}' || tags || '{TAG_SEPARATOR}', ?) > 0"
+
+    @staticmethod
+    def _tag_param(tag: str) -> str:
+        return f"{TAG_SEPARATOR}{tag.strip()}{TAG_SEPARATOR}"
+
+    @staticmethod
+    def _group_from_row(row) -> Group:
+        return Group._make(row)
     
     def update_group_tags(self, group_id: int, tags: str):
         cursor = self.conn.cursor()
-        cursor.execute('UPDATE groups SET tags = ? WHERE id = ?', (tags, group_id))
+        cursor.execute('UPDATE groups SET tags = ? WHERE id = ?', (normalize_tags(tags), group_id))
         self.conn.commit()
     
     # Методы работы с шаблонами
@@ -193,66 +763,559 @@ class Database:
         cursor = self.conn.cursor()
         cursor.execute('INSERT OR REPLACE INTO templates (name, content) VALUES (?, ?)', (name, content))
         self.conn.commit()
+        self.touch('templates')
     
     def remove_template(self, template_id: int):
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM templates WHERE id = ?', (template_id,))
         self.conn.commit()
+        self.touch('templates')
     
-    def get_templates(self) -> List[Dict]:
+    def get_templates(self) -> List[Template]:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT id, name, content FROM templates ORDER BY id')
+        return [self._template_from_row(row) for row in cursor.fetchall()]
+
+    def get_template(self, template_id: int) -> Optional[Template]:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT id, name, content FROM templates WHERE id = ?', (template_id,))
+        row = cursor.fetchone()
+        return self._template_from_row(row) if row else None
+
+    def count_templates(self) -> int:
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM templates')
-        return [{'id': row[0], 'name': row[1], 'content': row[2]} for row in cursor.fetchall()]
+        cursor.execute('SELECT COUNT(*) FROM templates')
+        return cursor.fetchone()[0]
+
+    def template_exists(self, name: str) -> bool:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM templates WHERE name = ?)', (name,))
+        return bool(cursor.fetchone()[0])
+
+    @staticmethod
+    def _template_from_row(row) -> Template:
+        return Template._make(row)
     
     # Методы работы с настройками
-    def get_setting(self, key: str) -> Optional[str]:
+    def load_settings(self):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+        cursor.execute('SELECT key, value FROM settings')
+        self._settings = dict(cursor.fetchall())
+
+    def get_setting(self, key: str) -> Optional[str]:
+        return self._settings.get(key)
     
     def set_setting(self, key: str, value: str):
+        self.set_settings({key: value})
+
+    def set_settings(self, values: Dict[str, Optional[str]]):
         cursor = self.conn.cursor()
-        cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+        cursor.executemany(
+            'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+            list(values.items())
+        )
         self.conn.commit()
+        self._settings.update(values)
+
+    def get_current_text(self) -> Optional[str]:
+        return self.get_setting('current_text')
+
+    def set_current_text(self, text: str):
+        self.set_setting('current_text', text)
+
+    def get_current_media(self) -> Tuple[Optional[str], Optional[str]]:
+        return self.get_setting('current_media_type'), self.get_setting('current_media_file_id')
+
+    def set_current_media(self, media_type: Optional[str], media_file_id: Optional[str]):
+        self.set_settings({
+            'current_media_type': media_type,
+            'current_media_file_id': media_file_id
+        })
+
+    def get_scheduled_time(self) -> Optional[time]:
+        value = self.get_setting('scheduled_time')
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, "%H:%M").time()
+        except ValueError:
+            return None
+
+    def set_scheduled_time(self, value: time):
+        self.set_setting('scheduled_time', value.strftime("%H:%M"))
     
     # Методы работы с расписанием
 
-    def add_scheduled_post(self, text: str, send_time: str, groups: List[str]):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT INTO scheduled_posts (text, send_time, groups) VALUES (?, ?, ?)',
-                (text, send_time, json.dumps(groups))
-    )
-        self.conn.commit()
+    def add_scheduled_posts(self, posts: List[ScheduledPost]) -> List[int]:
+        # Одной транзакцией: добавляются либо все посты (волны), либо ни один
+        post_ids = []
+        with self.transaction() as cursor:
+            for post in posts:
+                cursor.execute(
+                    'INSERT INTO scheduled_posts '
+                    '(text, send_time, groups, rule, next_fire_at, window_seconds, timezone, ttl_seconds) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (post.text, post.send_time, json.dumps(post.groups), post.rule, post.next_fire_at,
+                     post.window_seconds, post.timezone, post.ttl_seconds)
+                )
+                post_ids.append(cursor.lastrowid)
+        self.touch('scheduled_posts')
+        return post_ids
     
     def remove_scheduled_post(self, post_id: int):
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM scheduled_posts WHERE id = ?', (post_id,))
         self.conn.commit()
+        self.touch('scheduled_posts')
     
-    def get_scheduled_posts(self):
+    def get_scheduled_posts(self) -> List[ScheduledPost]:
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM scheduled_posts WHERE is_active = 1')
-        return [
-        {
-            'id': row[0],
-            'text': row[1],
-            'send_time': row[2],
-            'groups': json.loads(row[3]),
-            'media_type': row[4],
-            'media_file_id': row[5],
-            'is_active': bool(row[6])
-        }
-        for row in cursor.fetchall()
-    ]
-        
+        cursor.execute(
+            f'SELECT {self._POST_COLUMNS} FROM scheduled_posts WHERE is_active = 1 ORDER BY id'
+        )
+        return [self._post_from_row(row) for row in cursor.fetchall()]
+
+    def get_scheduled_posts_page(self, after_id: int = 0, before_id: Optional[int] = None,
+                                 limit: int = SCHEDULE_PAGE_SIZE) -> Tuple[List[ScheduledPost], bool]:
+        rows, more = self._page('scheduled_posts', self._POST_COLUMNS, 'is_active = 1', (),
+                                after_id, before_id, limit)
+        return [self._post_from_row(row) for row in rows], more
+
+    def get_scheduled_post(self, post_id: int) -> Optional[ScheduledPost]:
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f'SELECT {self._POST_COLUMNS} FROM scheduled_posts WHERE id = ? AND is_active = 1',
+            (post_id,)
+        )
+        row = cursor.fetchone()
+        return self._post_from_row(row) if row else None
+
+    def get_pending_posts(self) -> List[ScheduledPost]:
+        # Активные посты в порядке срабатывания (по индексу next_fire_at)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f'SELECT {self._POST_COLUMNS} FROM scheduled_posts '
+            f'WHERE is_active = 1 ORDER BY next_fire_at'
+        )
+        return [self._post_from_row(row) for row in cursor.fetchall()]
+
+    # Сведения о группах
+    def get_stale_groups(self, checked_before: float, limit: int = METADATA_BATCH_SIZE) -> List[Group]:
+        # Сначала никогда не проверенные группы, затем проверенные раньше всех
+        columns = ', '.join(f'g.{column}' for column in Group._fields)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f'SELECT {columns} FROM groups g LEFT JOIN group_health h ON h.group_id = g.id '
+            'WHERE h.checked_at IS NULL OR h.checked_at < ? '
+            'ORDER BY h.checked_at IS NOT NULL, h.checked_at, g.id LIMIT ?',
+            (checked_before, limit)
+        )
+        return [self._group_from_row(row) for row in cursor.fetchall()]
+
+    def save_group_health(self, records: Iterable[GroupHealth]):
+        with self.transaction() as cursor:
+            cursor.executemany(
+                f'INSERT OR REPLACE INTO group_health ({", ".join(GroupHealth._fields)}) '
+                f'VALUES ({", ".join("?" * len(GroupHealth._fields))})',
+                records
+            )
+        self.touch('group_health')
+
+    @staticmethod
+    def _health_from_row(row) -> GroupHealth:
+        health = GroupHealth._make(row)
+        return health._replace(can_post=None if health.can_post is None else bool(health.can_post))
+
+    def get_groups_health(self, group_ids: List[int]) -> Dict[int, GroupHealth]:
+        if not group_ids:
+            return {}
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f'SELECT {", ".join(GroupHealth._fields)} FROM group_health '
+            f'WHERE group_id IN ({", ".join("?" * len(group_ids))})',
+            group_ids
+        )
+        return {row[0]: self._health_from_row(row) for row in cursor.fetchall()}
+
+    def get_delivery_restrictions(self) -> Tuple[Set[str], Dict[str, int]]:
+        # -> (ссылки, куда нельзя писать; ссылка -> медленный режим, секунд)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT g.link, h.can_post, h.slow_mode_seconds FROM group_health h '
+            'JOIN groups g ON g.id = h.group_id WHERE h.can_post = 0 OR h.slow_mode_seconds > 0'
+        )
+        unpostable, slow_mode = set(), {}
+        for link, can_post, slow_mode_seconds in cursor.fetchall():
+            if can_post == 0:
+                unpostable.add(link)
+            elif slow_mode_seconds:
+                slow_mode[link] = slow_mode_seconds
+        return unpostable, slow_mode
+
+    def count_group_health(self) -> Tuple[int, int]:
+        # -> (проверено групп, недоступно для отправки)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT COUNT(*), COALESCE(SUM(h.can_post = 0), 0) FROM group_health h '
+            'JOIN groups g ON g.id = h.group_id'
+        )
+        return tuple(cursor.fetchone())
+
+    def count_scheduled_posts(self) -> int:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM scheduled_posts WHERE is_active = 1')
+        return cursor.fetchone()[0]
+
+    # Порядок столбцов совпадает с полями ScheduledPost
+    _POST_COLUMNS = ', '.join(ScheduledPost._fields)
+
+    @staticmethod
+    def _post_from_row(row) -> ScheduledPost:
+        post = ScheduledPost._make(row)
+        return post._replace(groups=json.loads(post.groups), is_active=bool(post.is_active))
     
-    def deactivate_scheduled_post(self, post_id: int):
+    def set_post_next_fire(self, post_id: int, next_fire_at: Optional[float]):
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE scheduled_posts SET next_fire_at = ? WHERE id = ?', (next_fire_at, post_id))
+        self.conn.commit()
+        self.touch('scheduled_posts')
+
+    def claim_post_fire(self, post_id: int, fire_at: float, next_fire_at: Optional[float],
+                        fired_at: Optional[float]) -> bool:
+        # Атомарно переводит пост со срабатывания fire_at на следующее.
+        # False - срабатывание уже обработано (например, другим экземпляром).
+        # Без следующего срабатывания пост отключается.
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'UPDATE scheduled_posts SET next_fire_at = ?, is_active = ?, '
+            'last_fired_at = COALESCE(?, last_fired_at) '
+            'WHERE id = ? AND is_active = 1 AND next_fire_at = ?',
+            (next_fire_at, int(next_fire_at is not None), fired_at, post_id, fire_at)
+        )
+        self.conn.commit()
+        self.touch('scheduled_posts')
+        return cursor.rowcount == 1
+
+    # Состояния диалогов FSM
+    def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT state, data FROM fsm_states WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def save_fsm_records(self, records: Iterable[Tuple[str, Optional[str], Dict[str, Any]]]) -> Tuple[int, int]:
+        # Пустые записи удаляются, остальные вставляются или обновляются.
+        # Возвращает счётчик изменений fsm_states до и после записи
+        records = list(records)
+        now = datetime.now(pytz.utc).timestamp()
+        with self.transaction() as cursor:
+            cursor.execute("SELECT version FROM table_changes WHERE name = 'fsm_states'")
+            before = cursor.fetchone()[0]
+            cursor.executemany(
+                'DELETE FROM fsm_states WHERE key = ?',
+                [(key,) for key, state, data in records if state is None and not data]
+            )
+            cursor.executemany(
+                'INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, '
+                'updated_at = excluded.updated_at',
+                [
+                    (key, state, json.dumps(data, ensure_ascii=False, default=str), now)
+                    for key, state, data in records if state is not None or data
+                ]
+            )
+            cursor.execute("SELECT version FROM table_changes WHERE name = 'fsm_states'")
+            return before, cursor.fetchone()[0]
+
+    # Аренда лидерства
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = datetime.now(pytz.utc).timestamp()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+            'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+            (name, owner, now + ttl, now)
+        )
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str):
         cursor = self.conn.cursor()
-        cursor.execute('UPDATE scheduled_posts SET is_active = 0 WHERE id = ?', (post_id,))
+        cursor.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
         self.conn.commit()
 
+# ======================
+# МИГРАЦИИ
+# ======================
+
+def migration_initial_schema(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS groups (
+                id INTEGER PRIMARY KEY,
+                link TEXT UNIQUE,
+                tags TEXT DEFAULT ''
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS templates (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE,
+                content TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_posts (
+                id INTEGER PRIMARY KEY,
+                text TEXT,
+                send_time TEXT,
+                groups TEXT,
+                is_active INTEGER DEFAULT 1
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_groups_tags ON groups(tags)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_posts_time ON scheduled_posts(send_time)')
+
+def migration_scheduled_posts_media(db: Database):
+    # В старых базах scheduled_posts создана без столбцов медиа.
+    # ADD COLUMN меняет только схему и не переписывает строки.
+    columns = db.get_columns('scheduled_posts')
+    with db.final_migration_step() as cursor:
+        if 'media_type' not in columns:
+            cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN media_type TEXT')
+        if 'media_file_id' not in columns:
+            cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN media_file_id TEXT')
+
+def migration_scheduled_posts_fire_times(db: Database):
+    # next_fire_at заполняется планировщиком при загрузке постов
+    with db.final_migration_step() as cursor:
+        cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN next_fire_at REAL')
+        cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN last_fired_at REAL')
+
+def migration_scheduled_posts_rules(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN rule TEXT')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_scheduled_posts_next_fire '
+            'ON scheduled_posts(is_active, next_fire_at)'
+        )
+
+def migration_scheduled_posts_window(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN window_seconds INTEGER')
+
+def migration_timezones(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN timezone TEXT')
+        cursor.execute('ALTER TABLE groups ADD COLUMN timezone TEXT')
+
+def migration_leases(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+def migration_scheduled_posts_ttl(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('ALTER TABLE scheduled_posts ADD COLUMN ttl_seconds INTEGER')
+
+def merge_tags(*tags: str) -> str:
+    # "a,b" + "b,c" -> "a,b,c"; разбор тот же, что у фильтра по тегу
+    return normalize_tags(TAG_SEPARATOR.join(value or '' for value in tags))
+
+def migration_canonical_group_links(db: Database):
+    # Разовая чистка: ссылки приводятся к каноническому виду, дубликаты
+    # удаляются (остаётся первая добавленная строка, теги объединяются).
+    # Повторный запуск после сбоя доводит чистку до конца.
+    if 'peer_id' not in db.get_columns('groups'):
+        with db.transaction() as cursor:
+            cursor.execute('ALTER TABLE groups ADD COLUMN peer_id INTEGER')
+    keepers: Dict[str, Tuple[int, str, str]] = {}  # канон -> (id, ссылка, теги)
+    duplicates: List[int] = []
+    last_id = 0
+    while True:
+        cursor = db.conn.cursor()
+        cursor.execute(
+            'SELECT id, link, tags FROM groups WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, MIGRATION_BATCH_SIZE)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for group_id, link, tags in rows:
+            canonical = normalize_group_link(link or '') or link
+            keeper = keepers.get(canonical)
+            if keeper is None:
+                keepers[canonical] = (group_id, link, tags or '')
+            else:
+                duplicates.append(group_id)
+                keepers[canonical] = (keeper[0], keeper[1], merge_tags(keeper[2], tags or ''))
+        last_id = rows[-1][0]
+    # Сначала теги: если сбой случится после удаления дубликатов, их теги
+    # уже будут у оставшейся строки
+    tag_updates = [(tags, group_id) for group_id, link, tags in keepers.values()]
+    for start in range(0, len(tag_updates), MIGRATION_BATCH_SIZE):
+        with db.transaction() as cursor:
+            cursor.executemany('UPDATE groups SET tags = ? WHERE id = ?',
+                               tag_updates[start:start + MIGRATION_BATCH_SIZE])
+    # Затем удаление: каноническая ссылка могла принадлежать дубликату
+    for start in range(0, len(duplicates), MIGRATION_BATCH_SIZE):
+        with db.transaction() as cursor:
+            cursor.executemany(
+                'DELETE FROM groups WHERE id = ?',
+                [(group_id,) for group_id in duplicates[start:start + MIGRATION_BATCH_SIZE]]
+            )
+    link_updates = [
+        (canonical, group_id) for canonical, (group_id, link, tags) in keepers.items() if link != canonical
+    ]
+    for start in range(0, len(link_updates), MIGRATION_BATCH_SIZE):
+        with db.transaction() as cursor:
+            cursor.executemany('UPDATE groups SET link = ? WHERE id = ?',
+                               link_updates[start:start + MIGRATION_BATCH_SIZE])
+    # Списки групп в запланированных постах
+    cursor = db.conn.cursor()
+    cursor.execute('SELECT id, groups FROM scheduled_posts')
+    posts = []
+    for post_id, groups in cursor.fetchall():
+        links = list(dict.fromkeys(normalize_group_link(link) or link for link in json.loads(groups or '[]')))
+        posts.append((json.dumps(links), post_id))
+    with db.final_migration_step() as cursor:
+        cursor.executemany('UPDATE scheduled_posts SET groups = ? WHERE id = ?', posts)
+        cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_groups_peer_id ON groups(peer_id) WHERE peer_id IS NOT NULL'
+        )
+    if duplicates:
+        logger.info(f"Удалено дубликатов групп: {len(duplicates)}")
+
+def migration_group_health(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_health (
+                group_id INTEGER PRIMARY KEY,
+                title TEXT,
+                peer_type TEXT,
+                members INTEGER,
+                slow_mode_seconds INTEGER DEFAULT 0,
+                can_post INTEGER,
+                error TEXT,
+                checked_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_group_health_checked ON group_health(checked_at)')
+
+def migration_normalize_tags(db: Database):
+    # Теги приводятся к виду "a,b": фильтр по тегу ищет тег целиком
+    last_id = 0
+    while True:
+        cursor = db.conn.cursor()
+        cursor.execute(
+            'SELECT id, tags FROM groups WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, MIGRATION_BATCH_SIZE)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        updates = [(normalize_tags(tags), group_id) for group_id, tags in rows if (tags or '') != normalize_tags(tags)]
+        if updates:
+            with db.transaction() as cursor:
+                cursor.executemany('UPDATE groups SET tags = ? WHERE id = ?', updates)
+        last_id = rows[-1][0]
+    with db.final_migration_step() as cursor:
+        cursor.execute('DROP INDEX IF EXISTS idx_groups_tags')
+
+def create_change_triggers(cursor: sqlite3.Cursor, table: str, columns: Optional[str] = None):
+    # Счётчик в table_changes растёт при записи в таблицу из любого соединения.
+    # columns ограничивает UPDATE перечисленными столбцами.
+    cursor.execute('INSERT OR IGNORE INTO table_changes (name, version) VALUES (?, 0)', (table,))
+    bump = f"UPDATE table_changes SET version = version + 1 WHERE name = '{table}';"
+    for event in ('INSERT', 'DELETE', f'UPDATE OF {columns}' if columns else 'UPDATE'):
+        cursor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {table}_changes_{event.split()[0].lower()} '
+            f'AFTER {event} ON {table} BEGIN {bump} END'
+        )
+
+def migration_scheduled_posts_changes(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS table_changes (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # next_fire_at, last_fired_at и is_active меняет сам планировщик при
+        # срабатывании; отключённый или удалённый пост он пропустит и без
+        # перезагрузки (claim_post_fire)
+        create_change_triggers(
+            cursor, 'scheduled_posts',
+            'text, send_time, groups, media_type, media_file_id, rule, window_seconds, timezone, ttl_seconds'
+        )
+
+def migration_fsm_states_changes(db: Database):
+    with db.final_migration_step() as cursor:
+        create_change_triggers(cursor, 'fsm_states')
+
+def migration_menu_tables_changes(db: Database):
+    with db.final_migration_step() as cursor:
+        create_change_triggers(cursor, 'templates')
+        # Отключение поста убирает его из списков в меню. Планировщик после
+        # этого один раз перечитывает индекс
+        cursor.execute(
+            "CREATE TRIGGER IF NOT EXISTS scheduled_posts_changes_active "
+            "AFTER UPDATE OF is_active ON scheduled_posts WHEN OLD.is_active IS NOT NEW.is_active "
+            "BEGIN UPDATE table_changes SET version = version + 1 WHERE name = 'scheduled_posts'; END"
+        )
+
+def migration_group_health_changes(db: Database):
+    with db.final_migration_step() as cursor:
+        create_change_triggers(cursor, 'group_health')
+
+def migration_settings_changes(db: Database):
+    with db.final_migration_step() as cursor:
+        create_change_triggers(cursor, 'settings')
+
+def migration_fsm_states(db: Database):
+    with db.final_migration_step() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL
+            )
+        ''')
+
+# Порядок важен: номер версии записывается в schema_version последним шагом миграции
+MIGRATIONS = [
+    (1, migration_initial_schema),
+    (2, migration_scheduled_posts_media),
+    (3, migration_scheduled_posts_fire_times),
+    (4, migration_scheduled_posts_rules),
+    (5, migration_scheduled_posts_window),
+    (6, migration_timezones),
+    (7, migration_leases),
+    (8, migration_scheduled_posts_ttl),
+    (9, migration_fsm_states),
+    (10, migration_canonical_group_links),
+    (11, migration_group_health),
+    (12, migration_normalize_tags),
+    (13, migration_scheduled_posts_changes),
+    (14, migration_fsm_states_changes),
+    (15, migration_menu_tables_changes),
+    (16, migration_group_health_changes),
+    (17, migration_settings_changes),
+]
+
 db = Database()
 
 class Stats:
@@ -272,6 +1335,48 @@ stats = Stats()
 # ИНЛАЙН КЛАВИАТУРЫ
 # ======================
 
+class KeyboardRegistry:
+    # Статические меню строятся один раз при запуске. Динамические зависят от
+    # таблицы базы и пересобираются, только когда меняется её версия
+    # (Database.get_table_version), иначе отдаётся готовая клавиатура.
+    # Версия хранится в памяти; изменения от других экземпляров бота
+    # подхватывает фоновая проверка watch_table_changes.
+
+    def __init__(self):
+        self._dynamic: Dict[str, Tuple[int, Optional[InlineKeyboardMarkup]]] = {}
+
+    def static(self, build: Callable[[], InlineKeyboardMarkup]) -> Callable[[], InlineKeyboardMarkup]:
+        markup = build()
+
+        @wraps(build)
+        def get() -> InlineKeyboardMarkup:
+            return markup
+        return get
+
+    def dynamic(self, table: str):
+        def decorator(build: Callable[[], Optional[InlineKeyboardMarkup]]):
+            @wraps(build)
+            def get() -> Optional[InlineKeyboardMarkup]:
+                version = db.get_table_version(table)
+                cached = self._dynamic.get(build.__name__)
+                if cached is None or cached[0] != version:
+                    cached = (version, build())
+                    self._dynamic[build.__name__] = cached
+                return cached[1]
+            return get
+        return decorator
+
+keyboards = KeyboardRegistry()
+
+async def watch_table_changes():
+    while True:
+        await asyncio.sleep(TABLE_CHANGES_INTERVAL)
+        try:
+            db.sync_changes()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка проверки изменений таблиц: {e}")
+
+@keyboards.static
 def get_main_menu_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -291,6 +1396,7 @@ def get_main_menu_kb() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+@keyboards.static
 def get_groups_menu_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -304,38 +1410,26 @@ def get_groups_menu_kb() -> InlineKeyboardMarkup:
         width=2
     )
     builder.row(
-        InlineKeyboardButton(text="📋 Список", callback_data="view_groups"),
-        InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu"),
-        width=2
-    )
-    return builder.as_markup()
-
-def get_content_menu_kb() -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="📝 Текст", callback_data="set_text"),
-        InlineKeyboardButton(text="📋 Шаблоны", callback_data="templates_menu"),
-        width=2
-    )
-    builder.row(
-        InlineKeyboardButton(text="👁 Предпросмотр", callback_data="preview"),
-        InlineKeyboardButton(text="🚀 Отправить", callback_data="confirm_send"),
+        InlineKeyboardButton(text="🌍 Часовой пояс", callback_data="group_timezone"),
+        InlineKeyboardButton(text="📥 Импорт", callback_data="import_groups"),
         width=2
     )
     builder.row(
+        InlineKeyboardButton(text="📋 Список", callback_data="view_groups"),
         InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu"),
-        width=1
+        width=2
     )
     return builder.as_markup()
 
+@keyboards.dynamic('templates')
 def get_templates_menu_kb() -> InlineKeyboardMarkup:
     templates = db.get_templates()
     builder = InlineKeyboardBuilder()
     
     for template in templates:
         builder.button(
-            text=f"📝 {template['name'][:15]}", 
-            callback_data=f"use_template_{template['id']}"
+            text=f"📝 {template.name[:15]}", 
+            callback_data=f"use_template_{template.id}"
         )
     
     builder.adjust(2)
@@ -349,11 +1443,13 @@ def get_templates_menu_kb() -> InlineKeyboardMarkup:
         width=1
     )
     return builder.as_markup()
+
+@keyboards.static
 def get_content_menu_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
         InlineKeyboardButton(text="📝 Текст", callback_data="set_text"),
-        InlineKeyboardButton(text="🖼 Медиа", callback_data="add_media"),  # Новая кнопка
+        InlineKeyboardButton(text="🖼 Медиа", callback_data="add_media"),
         width=2
     )
     builder.row(
@@ -362,15 +1458,20 @@ def get_content_menu_kb() -> InlineKeyboardMarkup:
     )
     builder.row(
         InlineKeyboardButton(text="👁 Предпросмотр", callback_data="preview"),
-        InlineKeyboardButton(text="🚀 Отправить", callback_data="confirm_send"),
+        InlineKeyboardButton(text="🧪 Проверка", callback_data="preflight"),
         width=2
     )
+    builder.row(
+        InlineKeyboardButton(text="🚀 Отправить", callback_data="confirm_send"),
+        width=1
+    )
     builder.row(
         InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu"),
         width=1
     )
     return builder.as_markup()
 
+@keyboards.static
 def get_scheduler_menu_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -389,6 +1490,7 @@ def get_scheduler_menu_kb() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+@lru_cache(maxsize=256)
 def get_confirmation_kb(action: str = "") -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -404,6 +1506,37 @@ def get_confirmation_kb(action: str = "") -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+# Списки для удаления; None - список пуст
+@keyboards.dynamic('templates')
+def get_remove_template_kb() -> Optional[InlineKeyboardMarkup]:
+    templates = db.get_templates()
+    if not templates:
+        return None
+    builder = InlineKeyboardBuilder()
+    for template in templates:
+        builder.button(
+            text=f"🗑 {template.name}", 
+            callback_data=f"ask_remove_template_{template.id}"
+        )
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="templates_menu"))
+    return builder.as_markup()
+
+@keyboards.dynamic('scheduled_posts')
+def get_remove_schedule_kb() -> Optional[InlineKeyboardMarkup]:
+    posts = db.get_scheduled_posts()
+    if not posts:
+        return None
+    builder = InlineKeyboardBuilder()
+    for post in posts:
+        builder.button(
+            text=f"🗑 {post.rule or post.send_time} - {post.text[:20]}...", 
+            callback_data=f"ask_remove_schedule_{post.id}"
+        )
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="scheduler_menu"))
+    return builder.as_markup()
+
 # ======================
 # ОСНОВНЫЕ КОМАНДЫ
 # ======================
@@ -432,6 +1565,11 @@ async def main_menu(callback_query: types.CallbackQuery):
     finally:
         await callback_query.answer()
 
+# "❌ Нет" в подтверждениях
+@dp.callback_query(F.data.startswith("cancel_"))
+async def cancel_action(callback_query: types.CallbackQuery):
+    await main_menu(callback_query)
+
 # ======================
 # ОБРАБОТЧИКИ ГРУПП
 # ======================
@@ -474,12 +1612,8 @@ async def add_group_process(message: types.Message, state: FSMContext):
         await message.answer("❌ Добавление группы отменено", reply_markup=get_groups_menu_kb())
         return
     
-    link = message.text.strip()
-    if link.startswith('@'):
-        link = f"https://t.me/{link[1:]}"
-    
-    parsed = urlparse(link)
-    if not all([parsed.scheme, parsed.netloc]) or not parsed.netloc.endswith('t.me'):
+    link = normalize_group_link(message.text)
+    if link is None:
         await message.answer(
             "❌ Неверный формат ссылки. Используйте:\n"
             "• https://t.me/username\n"
@@ -490,93 +1624,277 @@ async def add_group_process(message: types.Message, state: FSMContext):
         )
         return
     
+    if db.group_exists(link):
+        await message.answer(f"ℹ️ Группа {link} уже есть в списке", reply_markup=get_groups_menu_kb())
+        await state.clear()
+        return
+    
     db.add_group(link)
     await message.answer(
         f"✅ Группа {link} добавлена!",
         reply_markup=get_groups_menu_kb()
     )
-    await state.clear()
+    await state.clear()
+
+# Строка импорта: ссылка, затем необязательные теги через пробел, запятую,
+# точку с запятой или табуляцию (как в CSV)
+IMPORT_LINE = re.compile(r'^\s*"?([^\s,;"]+)"?\s*(?:[,;\t ]\s*(.*))?$')
+
+def parse_group_import(text: str) -> Tuple[List[Tuple[str, str]], int, List[str]]:
+    # -> (новые строки (ссылка, теги), повторы внутри списка, неверные строки)
+    groups: Dict[str, str] = {}
+    duplicates = 0
+    invalid = []
+    for line in text.splitlines():
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        match = IMPORT_LINE.match(line)
+        link = normalize_group_link(match.group(1)) if match else None
+        if link is None:
+            invalid.append(line.strip())
+            continue
+        if link in groups:
+            duplicates += 1
+            continue
+        groups[link] = (match.group(2) or '').strip().strip('"')
+    return list(groups.items()), duplicates, invalid
+
+@dp.callback_query(F.data == "import_groups")
+async def import_groups_start(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.set_state(Form.import_groups)
+    await callback_query.message.edit_text(
+        "Отправьте список групп сообщением или файлом .txt/.csv, по одной на строку:\n\n"
+        "<code>https://t.me/username теги</code>\n"
+        "<code>@username, теги</code>\n\n"
+        "Теги необязательны, строки с # пропускаются.\n\n"
+        "✏️ Для отмены введите /cancel",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu")]
+        ]))
+    await callback_query.answer()
+
+@dp.message(Form.import_groups)
+async def import_groups_process(message: types.Message, state: FSMContext):
+    if message.text and message.text.startswith('/cancel'):
+        await state.clear()
+        await message.answer("❌ Импорт отменен", reply_markup=get_groups_menu_kb())
+        return
+    
+    if message.document:
+        name = (message.document.file_name or '').lower()
+        if not name.endswith(('.txt', '.csv')) or (message.document.file_size or 0) > IMPORT_MAX_FILE_SIZE:
+            await message.answer(f"❌ Нужен файл .txt или .csv до {IMPORT_MAX_FILE_SIZE // 1024 // 1024} МБ")
+            return
+        raw = (await bot.download(message.document, destination=io.BytesIO())).getvalue()
+        try:
+            text = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            # CSV из Excel на русской Windows
+            text = raw.decode('cp1251', errors='replace')
+    elif message.text:
+        text = message.text
+    else:
+        await message.answer("❌ Отправьте список текстом или файлом .txt/.csv")
+        return
+    
+    groups, duplicates, invalid = parse_group_import(text)
+    added = db.add_groups(groups) if groups else 0
+    await state.clear()
+    
+    report = (
+        f"📥 Импорт завершен:\n\n"
+        f"• Добавлено: {added}\n"
+        f"• Уже были в базе: {len(groups) - added}\n"
+        f"• Повторы в списке: {duplicates}\n"
+        f"• Неверных строк: {len(invalid)}"
+    )
+    if invalid:
+        report += "\n\nНапример:\n" + "\n".join(f"• {line[:60]}" for line in invalid[:5])
+    builder = InlineKeyboardBuilder()
+    if added:
+        builder.row(InlineKeyboardButton(text="🔎 Проверить новые группы", callback_data="resolve_import"))
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu"))
+    await message.answer(report, reply_markup=builder.as_markup())
+
+# startswith: кнопки в старых отчётах об импорте несут ещё и id
+@dp.callback_query(F.data.startswith("resolve_import"))
+async def resolve_import(callback_query: types.CallbackQuery):
+    # Новые группы ещё не проверялись, и фоновая проверка берёт их первыми;
+    # её нужно только разбудить. Она же ждёт окончания рассылок и FloodWait
+    metadata_refresher.wake()
+    await callback_query.message.edit_text(
+        "⏳ Новые группы проверяются в фоне. Недоступные покажет «🧪 Проверка» перед рассылкой",
+        reply_markup=get_groups_menu_kb()
+    )
+    await callback_query.answer()
 
-@dp.callback_query(F.data == "remove_group")
-async def remove_group_start(callback_query: types.CallbackQuery, state: FSMContext):
-    groups = db.get_groups()
+# Просмотр списков групп: groups - все группы, tag - фильтр по тегу
+# (тег хранится в данных FSM), remove - выбор группы для удаления,
+# tags - выбор группы для редактирования тегов
+def render_groups_page(view: str, tag: Optional[str] = None, after_id: int = 0,
+                       before_id: Optional[int] = None) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    groups, more = db.get_groups_page(after_id, before_id, tag)
+    if not groups and (after_id or before_id is not None):
+        # Страница опустела (группы удалены) - показываем начало списка
+        after_id, before_id = 0, None
+        groups, more = db.get_groups_page(tag=tag)
     if not groups:
+        return None
+    has_prev, has_next = (more, True) if before_id is not None else (after_id > 0, more)
+    
+    builder = InlineKeyboardBuilder()
+    if view == "remove":
+        for group in groups:
+            builder.button(text=f"🗑 #{group.id} {group.link}", callback_data=f"ask_remove_group_{group.id}")
+        builder.adjust(1)
+        text = "Выберите группу для удаления:"
+    elif view == "tags":
+        for group in groups:
+            builder.button(
+                text=f"#{group.id} {group.link} ({group.tags or 'нет тегов'})", callback_data=f"edit_tags_{group.id}"
+            )
+        builder.adjust(1)
+        text = "Выберите группу для редактирования тегов:"
+    else:
+        groups_list = "\n".join(f"#{g.id} {g.link} {'🏷 ' + g.tags if g.tags else ''}" for g in groups)
+        title = f"📋 Группы с тегом «{tag}»" if tag else "📋 Список групп"
+        text = f"{title}:\n\n{groups_list}"
+    
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"gpage:{view}:p:{groups[0].id}"))
+    nav.append(InlineKeyboardButton(text="🔎 Перейти", callback_data=f"gjump:{view}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"gpage:{view}:n:{groups[-1].id}"))
+    builder.row(*nav)
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu"))
+    return text, builder.as_markup()
+
+async def get_view_tag(view: str, state: FSMContext) -> Optional[str]:
+    return (await state.get_data()).get("filter_tag") if view == "tag" else None
+
+# Список по тегу без тега в данных FSM (например, после /cancel) не
+# подменяется списком всех групп
+TAG_FILTER_LOST = "Фильтр по тегу сброшен, задайте его заново"
+
+@dp.callback_query(F.data == "remove_group")
+async def remove_group_start(callback_query: types.CallbackQuery):
+    page = render_groups_page("remove")
+    if page is None:
         await callback_query.answer("Список групп пуст", show_alert=True)
         return
     
-    groups_list = "\n".join(f"{i+1}. {g['link']}" for i, g in enumerate(groups))
-    await callback_query.message.edit_text(
-        f"Введите номер группы для удаления:\n\n{groups_list}\n\n"
-        "✏️ Для отмены введите /cancel",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu")]
-        ]))
-    await state.set_state(Form.remove_group)
+    text, markup = page
+    await callback_query.message.edit_text(text, reply_markup=markup)
+    await callback_query.answer()
 
-@dp.message(Form.remove_group)
-async def remove_group_process(message: types.Message, state: FSMContext):
-    if message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Удаление отменено", reply_markup=get_groups_menu_kb())
+@dp.callback_query(F.data.startswith("ask_remove_group_"))
+async def confirm_remove_group(callback_query: types.CallbackQuery):
+    group = db.get_group(int(callback_query.data.split("_")[-1]))
+    if not group:
+        await callback_query.answer("❌ Группа не найдена", show_alert=True)
         return
     
-    try:
-        group_num = int(message.text.strip())
-        groups = db.get_groups()
-        
-        if 1 <= group_num <= len(groups):
-            db.remove_group(groups[group_num-1]['id'])
-            await message.answer(f"✅ Группа {groups[group_num-1]['link']} удалена!", 
-                               reply_markup=get_groups_menu_kb())
-        else:
-            await message.answer("❌ Неверный номер группы", 
-                               reply_markup=get_groups_menu_kb())
-    except ValueError:
-        await message.answer("❌ Введите число - номер группы", 
-                           reply_markup=get_groups_menu_kb())
-    finally:
-        await state.clear()
+    await callback_query.message.edit_text(
+        f"Вы уверены, что хотите удалить группу {group.link}?",
+        reply_markup=get_confirmation_kb(f"remove_group_{group.id}")
+    )
+    await callback_query.answer()
+
+@dp.callback_query(F.data.startswith("confirm_remove_group_"))
+async def remove_group_process(callback_query: types.CallbackQuery):
+    group = db.get_group(int(callback_query.data.split("_")[-1]))
+    if group:
+        db.remove_group(group.id)
+        entity_cache.pop(group.link, None)
+        await callback_query.message.edit_text(f"✅ Группа {group.link} удалена!",
+                                               reply_markup=get_groups_menu_kb())
+    else:
+        await callback_query.answer("❌ Группа не найдена", show_alert=True)
+    await callback_query.answer()
 
 @dp.callback_query(F.data == "view_groups")
 async def view_groups(callback_query: types.CallbackQuery):
     try:
-        groups = db.get_groups()
-        if not groups:
+        page = render_groups_page("groups")
+        if page is None:
             await callback_query.answer("📭 Список групп пуст", show_alert=True)
             return
         
-        groups_list = "\n".join(
-            f"{i+1}. {g['link']} {'🏷 ' + g['tags'] if g['tags'] else ''}"
-            for i, g in enumerate(groups))
-        
-        await callback_query.message.edit_text(
-            f"📋 Список групп ({len(groups)}):\n\n{groups_list}",
-            reply_markup=get_groups_menu_kb()
-        )
+        text, markup = page
+        await callback_query.message.edit_text(text, reply_markup=markup)
     except Exception as e:
         logger.error(f"Ошибка в view_groups: {e}")
         await callback_query.answer("⚠️ Произошла ошибка", show_alert=True)
     finally:
         await callback_query.answer()
 
-@dp.callback_query(F.data == "group_tags")
-async def group_tags_start(callback_query: types.CallbackQuery):
-    groups = db.get_groups()
-    builder = InlineKeyboardBuilder()
+@dp.callback_query(F.data.startswith("gpage:"))
+async def groups_page(callback_query: types.CallbackQuery, state: FSMContext):
+    _, view, direction, anchor = callback_query.data.split(":")
+    tag = await get_view_tag(view, state)
+    if view == "tag" and tag is None:
+        await callback_query.answer(TAG_FILTER_LOST, show_alert=True)
+        return
+    if direction == "p":
+        page = render_groups_page(view, tag, before_id=int(anchor))
+    else:
+        page = render_groups_page(view, tag, after_id=int(anchor))
+    if page is None:
+        await callback_query.answer("📭 Список групп пуст", show_alert=True)
+        return
     
-    for group in groups:
-        builder.button(
-            text=f"{group['link']} ({group['tags'] or 'нет тегов'})", 
-            callback_data=f"edit_tags_{group['id']}"
-        )
+    text, markup = page
+    await callback_query.message.edit_text(text, reply_markup=markup)
+    await callback_query.answer()
+
+@dp.callback_query(F.data.startswith("gjump:"))
+async def jump_to_start(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.set_state(Form.jump_to)
+    await state.update_data(jump_view=callback_query.data.split(":")[1])
+    await callback_query.message.edit_text(
+        "Введите ID группы (#N в списке) или начало ссылки (@username, t.me/...):\n\n"
+        "✏️ Для отмены введите /cancel",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu")]
+        ]))
+    await callback_query.answer()
+
+@dp.message(Form.jump_to)
+async def jump_to_process(message: types.Message, state: FSMContext):
+    # Состояние сбрасывается, а данные (тег фильтра) остаются для листания
+    await state.set_state(None)
+    if message.text.startswith('/cancel'):
+        await message.answer("❌ Поиск отменен", reply_markup=get_groups_menu_kb())
+        return
     
-    builder.adjust(1)
-    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu"))
+    view = (await state.get_data()).get("jump_view", "groups")
+    tag = await get_view_tag(view, state)
+    if view == "tag" and tag is None:
+        await message.answer(f"❌ {TAG_FILTER_LOST}", reply_markup=get_groups_menu_kb())
+        return
+    query = message.text.strip()
+    if query.lstrip('#').isdigit():
+        group = db.find_group_from_id(int(query.lstrip('#')), tag)
+    else:
+        group = db.find_group_by_link(link_search_prefix(query), tag)
+    page = render_groups_page(view, tag, after_id=group.id - 1) if group else None
+    if page is None:
+        await message.answer("❌ Группа не найдена", reply_markup=get_groups_menu_kb())
+        return
     
-    await callback_query.message.edit_text(
-        "Выберите группу для редактирования тегов:",
-        reply_markup=builder.as_markup()
-    )
+    text, markup = page
+    await message.answer(text, reply_markup=markup)
+
+@dp.callback_query(F.data == "group_tags")
+async def group_tags_start(callback_query: types.CallbackQuery):
+    page = render_groups_page("tags")
+    if page is None:
+        await callback_query.answer("Список групп пуст", show_alert=True)
+        return
+    
+    text, markup = page
+    await callback_query.message.edit_text(text, reply_markup=markup)
     await callback_query.answer()
 
 @dp.callback_query(F.data.startswith("edit_tags_"))
@@ -627,16 +1945,57 @@ async def filter_by_tag_process(message: types.Message, state: FSMContext):
         return
     
     tag = message.text.strip() if message.text.strip() else None
-    groups = db.get_groups(tag)
+    page = render_groups_page("tag" if tag else "groups", tag)
     
-    if not groups:
+    if page is None:
+        await state.clear()
         await message.answer("❌ Группы с таким тегом не найдены", 
                            reply_markup=get_groups_menu_kb())
         return
     
-    groups_list = "\n".join(f"{g['link']} - {g['tags']}" for g in groups)
+    # Тег остаётся в данных FSM для листания страниц
+    await state.set_state(None)
+    await state.update_data(filter_tag=tag)
+    text, markup = page
+    await message.answer(text, reply_markup=markup)
+
+@dp.callback_query(F.data == "group_timezone")
+async def group_timezone_start(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.set_state(Form.set_timezone)
+    await callback_query.message.edit_text(
+        "Введите часовой пояс для групп с тегом в формате:\n\n"
+        "Тег / Europe/Berlin\n\n"
+        "Без тега пояс будет установлен для всех групп. "
+        "Вместо пояса укажите - , чтобы вернуть общий пояс.\n\n"
+        "✏️ Для отмены введите /cancel",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu")]
+        ]))
+    await callback_query.answer()
+
+@dp.message(Form.set_timezone)
+async def group_timezone_process(message: types.Message, state: FSMContext):
+    if message.text.startswith('/cancel'):
+        await state.clear()
+        await message.answer("❌ Установка часового пояса отменена", reply_markup=get_groups_menu_kb())
+        return
+    
+    tag, _, timezone = message.text.rpartition(" / ")
+    tag = tag.strip() or None
+    timezone = timezone.strip()
+    if timezone == "-":
+        timezone = None
+    elif timezone not in pytz.all_timezones_set:
+        await message.answer(
+            "❌ Неизвестный часовой пояс. Пример: Europe/Moscow, Asia/Almaty",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="groups_menu")]
+            ]))
+        return
+    
+    updated = db.set_groups_timezone(timezone, tag)
     await message.answer(
-        f"📋 Найдено групп: {len(groups)}\n\n{groups_list}",
+        f"✅ Часовой пояс {timezone or TIMEZONE} установлен для групп: {updated}",
         reply_markup=get_groups_menu_kb()
     )
     await state.clear()
@@ -700,8 +2059,7 @@ async def add_media_process(message: types.Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, отправьте фото или видео.")
         return
 
-    db.set_setting('current_media_type', media_type)
-    db.set_setting('current_media_file_id', file_id)
+    db.set_current_media(media_type, file_id)
 
     await message.answer(
         "✅ Медиафайл сохранен!",
@@ -716,7 +2074,7 @@ async def set_text_process(message: types.Message, state: FSMContext):
         await message.answer("❌ Установка текста отменена", reply_markup=get_content_menu_kb())
         return
     
-    db.set_setting('current_text', message.text)
+    db.set_current_text(message.text)
     await message.answer(
         "✅ Текст сохранен!",
         reply_markup=get_content_menu_kb()
@@ -739,17 +2097,16 @@ async def templates_menu(callback_query: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("use_template_"))
 async def use_template(callback_query: types.CallbackQuery):
     template_id = int(callback_query.data.split("_")[-1])
-    templates = db.get_templates()
-    template = next((t for t in templates if t['id'] == template_id), None)
+    template = db.get_template(template_id)
     
     if not template:
         await callback_query.answer("❌ Шаблон не найден", show_alert=True)
         return
     
-    db.set_setting('current_text', template['content'])
+    db.set_current_text(template.content)
     await callback_query.message.edit_text(
-        f"✅ Шаблон '{template['name']}' применен!\n\n"
-        f"Текст:\n{template['content']}",
+        f"✅ Шаблон '{template.name}' применен!\n\n"
+        f"Текст:\n{template.content}",
         reply_markup=get_content_menu_kb()
     )
     await callback_query.answer()
@@ -784,9 +2141,11 @@ async def add_template_process(message: types.Message, state: FSMContext):
         name = name.strip()
         content = content.strip()
         
+        # Шаблон с тем же названием перезаписывается, пользователю сообщаем об этом
+        replaced = db.template_exists(name)
         db.add_template(name, content)
         await message.answer(
-            f"✅ Шаблон '{name}' добавлен!",
+            f"✅ Шаблон '{name}' обновлён!" if replaced else f"✅ Шаблон '{name}' добавлен!",
             reply_markup=get_templates_menu_kb()
         )
     except ValueError:
@@ -803,39 +2162,28 @@ async def add_template_process(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == "remove_template")
 async def remove_template_start(callback_query: types.CallbackQuery):
-    templates = db.get_templates()
-    if not templates:
+    markup = get_remove_template_kb()
+    if markup is None:
         await callback_query.answer("Список шаблонов пуст", show_alert=True)
         return
     
-    builder = InlineKeyboardBuilder()
-    for template in templates:
-        builder.button(
-            text=f"🗑 {template['name']}", 
-            callback_data=f"confirm_remove_template_{template['id']}"
-        )
-    
-    builder.adjust(1)
-    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="templates_menu"))
-    
     await callback_query.message.edit_text(
         "Выберите шаблон для удаления:",
-        reply_markup=builder.as_markup()
+        reply_markup=markup
     )
     await callback_query.answer()
 
-@dp.callback_query(F.data.startswith("confirm_remove_template_"))
+@dp.callback_query(F.data.startswith("ask_remove_template_"))
 async def confirm_remove_template(callback_query: types.CallbackQuery):
     template_id = int(callback_query.data.split("_")[-1])
-    templates = db.get_templates()
-    template = next((t for t in templates if t['id'] == template_id), None)
+    template = db.get_template(template_id)
     
     if not template:
         await callback_query.answer("❌ Шаблон не найден", show_alert=True)
         return
     
     await callback_query.message.edit_text(
-        f"Вы уверены, что хотите удалить шаблон '{template['name']}'?",
+        f"Вы уверены, что хотите удалить шаблон '{template.name}'?",
         reply_markup=get_confirmation_kb(f"remove_template_{template_id}")
     )
     await callback_query.answer()
@@ -851,12 +2199,11 @@ async def remove_template_process(callback_query: types.CallbackQuery):
     )
     await callback_query.answer()
 
-@dp.callback_query(F.data == "preview")
+@dp.callback_query(F.data == "preview", flags={"heavy": True})
 async def preview_content(callback_query: types.CallbackQuery):
     try:
-        text = db.get_setting('current_text')
-        media_type = db.get_setting('current_media_type')
-        media_file_id = db.get_setting('current_media_file_id')
+        text = db.get_current_text()
+        media_type, media_file_id = db.get_current_media()
 
         if not text and not media_file_id:
             await callback_query.answer("❌ Текст или медиа не установлены", show_alert=True)
@@ -889,74 +2236,772 @@ async def preview_content(callback_query: types.CallbackQuery):
 # ОБРАБОТЧИКИ ОТПРАВКИ
 # ======================
 
-async def send_to_group(group_link: str, text: str, media_type: str = None, media_file_id: str = None) -> bool:
+class LRUCache(OrderedDict):
+    # Словарь ограниченного размера: при переполнении вытесняется запись,
+    # к которой дольше всего не обращались
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+# Кэши подготовки рассылки: сущности адресатов, загруженные медиа
+# и разобранный HTML. Заполняются заранее (prewarm_post) или при первой отправке.
+entity_cache: LRUCache = LRUCache(ENTITY_CACHE_SIZE)
+prepared_media: Dict[str, object] = {}
+media_locks: Dict[str, asyncio.Lock] = {}
+# Момент (time.monotonic шкалы event loop), до которого аккаунт во FloodWait
+flood_until = 0.0
+# Средняя длительность одной отправки без учёта паузы SEND_INTERVAL, секунд;
+# уточняется по фактическим отправкам и входит в прогноз длительности рассылки
+send_latency = 0.5
+# Из group_health: группы, куда аккаунт не может писать, и медленный режим.
+# Сверяются с версией group_health при постановке рассылки и после проверки групп.
+unpostable_links: Set[str] = set()
+slow_mode_links: Dict[str, int] = {}
+restrictions_version: Optional[int] = None
+# Момент (шкала event loop), раньше которого в чат нельзя писать из-за
+# медленного режима; остальные чаты при этом не ждут
+chat_ready_at: Dict[str, float] = {}
+
+def set_flood_wait(seconds: int):
+    global flood_until
+    flood_until = max(flood_until, asyncio.get_running_loop().time() + seconds)
+
+def flood_wait_remaining() -> float:
+    return max(flood_until - asyncio.get_running_loop().time(), 0)
+
+def record_send_latency(seconds: float):
+    # Скользящее среднее: одна медленная отправка не искажает прогноз
+    global send_latency
+    send_latency += (seconds - send_latency) * 0.2
+
+async def wait_for_flood():
+    # Все отправители ждут окончания FloodWait, а не только получивший его
+    remaining = flood_wait_remaining()
+    if remaining:
+        await asyncio.sleep(remaining)
+
+class DuplicateGroupError(Exception):
+    pass
+
+# Ссылки, оказавшиеся другим написанием уже добавленной группы -> её ссылка
+duplicate_links: Dict[str, str] = {}
+
+async def resolve_target(link: str, remove_duplicate: bool = True):
+    # remove_duplicate=False - для проверок без последствий: дубликат
+    # сообщается, но не удаляется из базы
+    if link in duplicate_links:
+        raise DuplicateGroupError(f"{link} - та же группа, что и {duplicate_links[link]}")
+    entity = entity_cache.get(link)
+    if entity is None:
+        entity = await client.get_input_entity(link)
+        owner = db.set_group_peer_id(link, get_peer_id(entity), remove_duplicate)
+        if owner is not None:
+            if remove_duplicate:
+                duplicate_links[link] = owner
+                logger.warning(f"{link} - та же группа, что и {owner}; дубликат удален из базы")
+            raise DuplicateGroupError(f"{link} - та же группа, что и {owner}")
+        entity_cache[link] = entity
+    return entity
+
+@lru_cache(maxsize=64)
+def compile_message(text: str) -> Tuple[str, list]:
+    # HTML разбирается один раз на текст, а не на каждую группу
+    return telethon_html.parse(text)
+
+async def prepare_media(media_type: str, media_file_id: str):
+    # file_id из Bot API недоступен пользовательскому аккаунту: файл один раз
+    # скачивается ботом и загружается клиентом, дальше используется загруженный
+    media = prepared_media.get(media_file_id)
+    if media is not None:
+        return media
+    async with media_locks.setdefault(media_file_id, asyncio.Lock()):
+        media = prepared_media.get(media_file_id)
+        if media is None:
+            buffer = await bot.download(media_file_id, destination=io.BytesIO())
+            file_name = "video.mp4" if media_type == "video" else "photo.jpg"
+            media = await client.upload_file(buffer, file_name=file_name)
+            prepared_media[media_file_id] = media
+            logger.info(f"Медиа {media_type} загружено для рассылки")
+    return media
+
+async def send_to_group(group_link: str, text: str, media_type: str = None, media_file_id: str = None,
+                        deadline: Optional[float] = None) -> Optional[bool]:
+    # None - срок актуальности истёк, пока ждали FloodWait или повтор
     for attempt in range(3):
         try:
+            await wait_for_flood()
+            if deadline is not None and datetime.now(pytz.utc).timestamp() >= deadline:
+                return None
+            entity = await resolve_target(group_link)
             async with send_semaphore:
-                if media_type == "photo":
-                    await client.send_file(
-                        group_link,
-                        media_file_id,
-                        caption=text or "Без текста",
-                        parse_mode="HTML"
-                    )
-                elif media_type == "video":
-                    await client.send_file(
-                        group_link,
-                        media_file_id,
-                        caption=text or "Без текста",
-                        parse_mode="HTML"
+                started = asyncio.get_running_loop().time()
+                if media_type in ("photo", "video") and media_file_id:
+                    message_text, entities = compile_message(text or "Без текста")
+                    media = await prepare_media(media_type, media_file_id)
+                    sent = await client.send_file(
+                        entity,
+                        media,
+                        caption=message_text,
+                        formatting_entities=entities,
+                        supports_streaming=media_type == "video"
                     )
+                    # Медиа отправленного сообщения переиспользуется без загрузки
+                    if getattr(sent, 'media', None) is not None:
+                        prepared_media[media_file_id] = sent.media
                 else:
+                    message_text, entities = compile_message(text)
                     await client.send_message(
-                        group_link,
-                        text,
-                        parse_mode="HTML"
+                        entity,
+                        message_text,
+                        formatting_entities=entities
                     )
-                await asyncio.sleep(1.2)  # минимальная задержка между отправками
+                record_send_latency(asyncio.get_running_loop().time() - started)
+                await asyncio.sleep(SEND_INTERVAL)  # минимальная задержка между отправками
             return True
+        except (DuplicateGroupError, SlowModeWaitError):
+            # Не повторяем здесь: дубликат движок считает пропущенным,
+            # а при медленном режиме откладывает только этот чат
+            raise
         except FloodWaitError as e:
             logger.warning(f"FloodWait: ждем {e.seconds} секунд")
-            await asyncio.sleep(e.seconds)
+            set_flood_wait(e.seconds)
         except Exception as e:
             logger.error(f"Ошибка при отправке (попытка {attempt + 1}): {e}")
             if attempt < 2:
                 await asyncio.sleep(5 * (attempt + 1))
     return False
 
+async def prewarm_post(post: ScheduledPost):
+    # Подготовка к запланированной отправке: к моменту срабатывания адресаты
+    # разрешены, медиа загружено, текст разобран, и рассылка сразу идёт
+    # на полной скорости
+    started = asyncio.get_running_loop().time()
+    resolved = failed = 0
+    for link in post.groups:
+        if link in entity_cache:
+            resolved += 1
+            continue
+        if flood_wait_remaining():
+            logger.warning(f"Подготовка поста {post.id} прервана: аккаунт во FloodWait")
+            break
+        try:
+            await resolve_target(link)
+            resolved += 1
+        except FloodWaitError as e:
+            set_flood_wait(e.seconds)
+            logger.warning(f"Подготовка поста {post.id} прервана: FloodWait {e.seconds} с")
+            break
+        except Exception as e:
+            failed += 1
+            logger.warning(f"Не удалось разрешить {link} при подготовке поста {post.id}: {e}")
+        await asyncio.sleep(RESOLVE_INTERVAL)
+    if post.media_file_id and post.media_type:
+        try:
+            await prepare_media(post.media_type, post.media_file_id)
+        except Exception as e:
+            logger.error(f"Не удалось подготовить медиа поста {post.id}: {e}")
+    compile_message((post.text or "Без текста") if post.media_file_id else (post.text or ""))
+    remaining = flood_wait_remaining()
+    logger.info(
+        f"Пост {post.id} подготовлен за {asyncio.get_running_loop().time() - started:.1f} с: "
+        f"адресатов {resolved}, ошибок {failed}"
+        + (f", FloodWait ещё {int(remaining)} с" if remaining else "")
+    )
+
+def load_delivery_restrictions():
+    # Перечитываются, только если group_health менялась: своими записями
+    # (Database.touch) или другим экземпляром (watch_table_changes)
+    global unpostable_links, slow_mode_links, restrictions_version
+    version = db.get_table_version('group_health')
+    if version != restrictions_version:
+        unpostable_links, slow_mode_links = db.get_delivery_restrictions()
+        restrictions_version = version
+
+def can_post_to(entity) -> bool:
+    # Право писать по данным самой сущности, без пробной отправки
+    if isinstance(entity, User):
+        return not entity.deleted
+    if not isinstance(entity, (Channel, Chat)):
+        return False  # ChannelForbidden, ChatForbidden: аккаунт исключён
+    if entity.left or getattr(entity, 'deactivated', False) or getattr(entity, 'migrated_to', None):
+        return False
+    if entity.creator:
+        return True
+    if isinstance(entity, Channel) and entity.broadcast:
+        return bool(entity.admin_rights and entity.admin_rights.post_messages)
+    if entity.admin_rights:
+        return True
+    banned = getattr(entity, 'banned_rights', None)
+    if banned and banned.send_messages:
+        return False
+    return not (entity.default_banned_rights and entity.default_banned_rights.send_messages)
+
+# Ошибки, после которых группа точно недоступна (а не временный сбой)
+UNREACHABLE_ERRORS = (ValueError, ChannelPrivateError, UsernameInvalidError, UsernameNotOccupiedError)
+
+async def fetch_group_health(group: Group, remove_duplicate: bool = True) -> GroupHealth:
+    # FloodWaitError пробрасывается: вызывающий прерывает проход.
+    # DuplicateGroupError тоже: у дубликата нет своих сведений
+    now = datetime.now(pytz.utc).timestamp()
+    try:
+        input_entity = await resolve_target(group.link, remove_duplicate)
+        slow_mode_seconds = 0
+        if isinstance(input_entity, InputPeerChannel):
+            # Один запрос: полные сведения плюс сама сущность канала с правами
+            result = await client(GetFullChannelRequest(input_entity))
+            full = result.full_chat
+            entity = next(chat for chat in result.chats if chat.id == full.id)
+            members = full.participants_count
+            # На администраторов медленный режим не распространяется
+            if not (entity.creator or entity.admin_rights):
+                slow_mode_seconds = full.slowmode_seconds or 0
+        else:
+            entity = await client.get_entity(input_entity)
+            members = getattr(entity, 'participants_count', None)
+        if isinstance(entity, Channel):
+            peer_type = "channel" if entity.broadcast else "supergroup"
+        elif isinstance(entity, Chat):
+            peer_type = "group"
+        else:
+            peer_type = "user"
+        title = getattr(entity, 'title', None) or " ".join(
+            filter(None, [getattr(entity, 'first_name', None), getattr(entity, 'last_name', None)])
+        )
+        can_post = can_post_to(entity)
+        if can_post and getattr(entity, 'forum', False) and not (entity.creator or entity.admin_rights):
+            # В форуме сообщение без темы уходит в общую тему (id 1); закрытая
+            # тема принимает сообщения только от администраторов
+            topics = (await client(GetForumTopicsByIDRequest(entity, topics=[1]))).topics
+            can_post = not (topics and getattr(topics[0], 'closed', False))
+        return GroupHealth(group.id, title, peer_type, members, slow_mode_seconds, can_post, None, now)
+    except (FloodWaitError, DuplicateGroupError):
+        raise
+    except UNREACHABLE_ERRORS as e:
+        return GroupHealth(group.id, can_post=False, error=str(e)[:200], checked_at=now)
+    except Exception as e:
+        return GroupHealth(group.id, error=str(e)[:200], checked_at=now)
+
+class MetadataRefresher:
+    # Фоновая проверка групп: тип, участники, медленный режим, право писать.
+    # Пачками по METADATA_BATCH_SIZE, сначала непроверенные, затем устаревшие
+    # (старше METADATA_REFRESH_HOURS), в темпе RESOLVE_INTERVAL. Во время
+    # рассылок, проверок перед рассылкой и FloodWait проверка ждёт, чтобы
+    # не тратить лимиты аккаунта.
+    IDLE_SLEEP = 600
+    BUSY_SLEEP = 30
 
-@dp.callback_query(F.data == "confirm_send")
-async def confirm_send(callback_query: types.CallbackQuery):
+    def __init__(self):
+        # Число идущих проверок перед рассылкой (preflight)
+        self.preflights = 0
+        # Будит проверку раньше IDLE_SLEEP, например после импорта групп.
+        # Проверка идёт только в экземпляре, владеющем арендой "metadata";
+        # в остальных новые группы подождут следующего прохода
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def busy(self) -> bool:
+        return bool(broadcast_engine.active_jobs or self.preflights)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                checked = await self.refresh_batch()
+            except Exception as e:
+                logger.error(f"Ошибка проверки групп: {e}")
+                checked = 0
+            if checked:
+                await asyncio.sleep(RESOLVE_INTERVAL)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.IDLE_SLEEP)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refresh_batch(self) -> int:
+        while self.busy():
+            await asyncio.sleep(self.BUSY_SLEEP)
+        await wait_for_flood()
+        checked_before = datetime.now(pytz.utc).timestamp() - METADATA_REFRESH_HOURS * 3600
+        records = []
+        for group in db.get_stale_groups(checked_before):
+            if self.busy():
+                break
+            try:
+                records.append(await fetch_group_health(group))
+            except DuplicateGroupError:
+                continue  # строка дубликата уже удалена
+            except FloodWaitError as e:
+                set_flood_wait(e.seconds)
+                break
+            await asyncio.sleep(RESOLVE_INTERVAL)
+        if records:
+            db.save_group_health(records)
+            load_delivery_restrictions()
+            logger.info(
+                f"Проверено групп: {len(records)}, "
+                f"недоступно: {sum(1 for record in records if record.can_post is False)}"
+            )
+        return len(records)
+
+metadata_refresher = MetadataRefresher()
+
+class PreflightReport(NamedTuple):
+    total: int = 0
+    deliverable: int = 0
+    blocked: int = 0
+    # Не удалось проверить (временная ошибка или FloodWait)
+    unknown: int = 0
+    # Сколько групп проверено запросами к Telegram, остальные взяты из group_health
+    checked: int = 0
+    interrupted: bool = False
+    # Другое написание уже добавленной группы: рассылка их пропустит
+    duplicates: int = 0
+    # Сколько секунд ещё ждать чат, недавно получивший сообщение в медленном режиме
+    slow_mode_wait: float = 0
+
+async def preflight(on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> PreflightReport:
+    # Пробный прогон рассылки без отправки: для каждой группы выясняется, может
+    # ли аккаунт туда писать. Свежие сведения берутся из group_health, остальные
+    # запрашиваются пачками в темпе RESOLVE_INTERVAL и сохраняются туда же.
+    # При FloodWait проверка через Telegram прекращается, непроверенные группы
+    # считаются неизвестными. Фоновая проверка групп на это время ставится на паузу.
+    metadata_refresher.preflights += 1
     try:
-        text = db.get_setting('current_text')
-        groups = db.get_groups()
-        
-        if not text or not groups:
-            await callback_query.answer("❌ Текст или группы не установлены", show_alert=True)
+        total = db.count_groups()
+        fresh_after = datetime.now(pytz.utc).timestamp() - PREFLIGHT_FRESH_MINUTES * 60
+        deliverable = blocked = unknown = checked = done = duplicates = 0
+        slow_mode_wait = 0.0
+        interrupted = False
+        now = asyncio.get_running_loop().time()
+        after_id = 0
+        while True:
+            groups, more = db.get_groups_page(after_id, limit=METADATA_BATCH_SIZE)
+            if not groups:
+                break
+            health = db.get_groups_health([group.id for group in groups])
+            records = []
+            for group in groups:
+                record = health.get(group.id)
+                if record is None or record.checked_at < fresh_after:
+                    record = None
+                    if not interrupted and not flood_wait_remaining():
+                        try:
+                            # Проверка ничего не меняет: дубликаты только считаются
+                            record = await fetch_group_health(group, remove_duplicate=False)
+                            records.append(record)
+                            checked += 1
+                            await asyncio.sleep(RESOLVE_INTERVAL)
+                        except DuplicateGroupError:
+                            duplicates += 1
+                            checked += 1
+                            await asyncio.sleep(RESOLVE_INTERVAL)
+                            continue
+                        except FloodWaitError as e:
+                            set_flood_wait(e.seconds)
+                            interrupted = True
+                    else:
+                        interrupted = True
+                if record is None or record.can_post is None:
+                    unknown += 1
+                elif record.can_post:
+                    deliverable += 1
+                    slow_mode_wait = max(slow_mode_wait, chat_ready_at.get(group.link, now) - now)
+                else:
+                    blocked += 1
+            if records:
+                db.save_group_health(records)
+            done += len(groups)
+            after_id = groups[-1].id
+            if on_progress:
+                await on_progress(done, total)
+            if not more:
+                break
+        load_delivery_restrictions()
+        return PreflightReport(
+            max(total, done), deliverable, blocked, unknown, checked, interrupted, duplicates, slow_mode_wait
+        )
+    finally:
+        metadata_refresher.preflights -= 1
+
+class BroadcastResult(NamedTuple):
+    success: int = 0
+    errors: int = 0
+    # Не отправлено: истёк срок актуальности / нет права писать /
+    # другое написание группы, получившей рассылку под основной ссылкой
+    expired: int = 0
+    skipped: int = 0
+    duplicates: int = 0
+
+class BroadcastJob:
+    # Сколько адресатов может ждать окончания медленного режима. Дальше
+    # чтение новых адресатов приостанавливается до освобождения чатов,
+    # чтобы повторная рассылка по недавним чатам не читала всю аудиторию
+    MAX_DEFERRED = 500
+
+    def __init__(self, name: str, targets: Iterable[str], text: str,
+                 media_type: str = None, media_file_id: str = None, interval: float = 0,
+                 deadline: Optional[float] = None):
+        self.name = name
+        self.text = text
+        self.media_type = media_type
+        self.media_file_id = media_file_id
+        self.success = 0
+        self.errors = 0
+        self.expired = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.in_flight = 0
+        self.exhausted = False
+        # Пауза между отправками этого задания (окно доставки), секунд
+        self.interval = interval
+        self.next_send_at = 0.0
+        # Срок актуальности, секунды UTC (epoch); после него адресаты не отправляются
+        self.deadline = deadline
+        # Адресаты, отложенные из-за медленного режима: куча (готов к отправке, ссылка)
+        self.deferred: List[Tuple[float, str]] = []
+        self.deferrals: Dict[str, int] = {}
+        self._targets = iter(targets)
+        self.done = asyncio.get_running_loop().create_future()
+
+    @property
+    def priority(self) -> float:
+        return self.deadline if self.deadline is not None else float('inf')
+
+    @property
+    def saturated(self) -> bool:
+        return len(self.deferred) >= self.MAX_DEFERRED
+
+    def ready_at(self) -> float:
+        # Когда у задания появится адресат: после чтения всех адресатов
+        # или при переполненной очереди отложенных - только из отложенных
+        if (self.exhausted or self.saturated) and self.deferred:
+            return max(self.next_send_at, self.deferred[0][0])
+        return self.next_send_at
+
+    async def wait(self) -> BroadcastResult:
+        return await asyncio.shield(self.done)
+
+class BroadcastEngine:
+    # Рассылки выполняются как независимые задания. Отправители берут
+    # адресатов по кругу из всех активных заданий, поэтому одна большая
+    # рассылка не задерживает остальные. Адресат читается из итератора
+    # только когда отправитель свободен - это и есть обратное давление.
+
+    # Сколько раз адресат откладывается из-за медленного режима, прежде чем
+    # считаться ошибкой
+    MAX_DEFERRALS = 3
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self._jobs = deque()
+        self._ready = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def submit(self, name: str, targets: Iterable[str], text: str,
+               media_type: str = None, media_file_id: str = None, interval: float = 0,
+               deadline: Optional[float] = None) -> BroadcastJob:
+        job = BroadcastJob(name, targets, text, media_type, media_file_id, interval, deadline)
+        load_delivery_restrictions()
+        self._jobs.append(job)
+        logger.info(f"Рассылка '{name}' поставлена в очередь, активных заданий: {len(self._jobs)}")
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._ready.set()
+        return job
+
+    def _next_target(self) -> Tuple[Optional[Tuple[BroadcastJob, str]], Optional[float]]:
+        # Возвращает следующего адресата или время до готовности ближайшего задания.
+        # Из готовых заданий первым идёт то, у которого срок актуальности ближе;
+        # задания без срока чередуются по кругу. У просроченного задания
+        # оставшиеся адресаты списываются, а не отправляются.
+        now = asyncio.get_running_loop().time()
+        wall_now = datetime.now(pytz.utc).timestamp()
+        wait = None
+        while self._jobs:
+            job = None
+            for candidate in self._jobs:
+                ready_at = candidate.ready_at()
+                if ready_at > now:
+                    delay = ready_at - now
+                    wait = delay if wait is None else min(wait, delay)
+                elif job is None or candidate.priority < job.priority:
+                    job = candidate
+            if job is None:
+                break
+            self._jobs.remove(job)
+            if job.deadline is not None and wall_now >= job.deadline:
+                self._expire(job)
+                continue
+            link = self._take_target(job, now)
+            if link is None:
+                if job.deferred:
+                    self._jobs.append(job)
+                else:
+                    self._finish_if_done(job)
+                continue
+            self._jobs.append(job)
+            job.in_flight += 1
+            job.next_send_at = now + job.interval
+            return (job, link), None
+        return None, wait
+
+    def _take_target(self, job: BroadcastJob, now: float) -> Optional[str]:
+        # Сначала отложенный адресат, чей чат уже свободен, затем новые.
+        # None - новых адресатов нет (задание прочитано до конца) или
+        # отложенных уже MAX_DEFERRED и нужно дождаться, пока чаты освободятся.
+        if job.deferred and job.deferred[0][0] <= now:
+            return heapq.heappop(job.deferred)[1]
+        while not job.exhausted and not job.saturated:
+            try:
+                link = next(job._targets)
+            except StopIteration:
+                job.exhausted = True
+                break
+            except Exception as e:
+                logger.error(f"Ошибка чтения адресатов рассылки '{job.name}': {e}")
+                job.exhausted = True
+                break
+            # Группы, куда аккаунт не может писать, пропускаются без попытки
+            if link in unpostable_links:
+                job.skipped += 1
+                continue
+            ready_at = chat_ready_at.get(link, 0.0)
+            if ready_at > now:
+                heapq.heappush(job.deferred, (ready_at, link))
+                continue
+            chat_ready_at.pop(link, None)
+            return link
+        return None
+
+    def _defer(self, job: BroadcastJob, link: str, seconds: float):
+        ready_at = asyncio.get_running_loop().time() + seconds
+        chat_ready_at[link] = ready_at
+        job.deferrals[link] = job.deferrals.get(link, 0) + 1
+        if job.deferrals[link] > self.MAX_DEFERRALS:
+            logger.warning(f"{link}: медленный режим не дал отправить рассылку '{job.name}'")
+            job.errors += 1
+            stats.increment_errors()
+            self._finish_if_done(job)
             return
-        
-        await callback_query.message.edit_text("⏳ Начинаю отправку...")
-        
-        success = 0
-        errors = 0
-        
-        for group in groups:
-            if await send_to_group(group['link'], text):
-                success += 1
+        logger.info(f"{link}: медленный режим, отправка отложена на {int(seconds)} с")
+        heapq.heappush(job.deferred, (ready_at, link))
+        if job not in self._jobs:
+            self._jobs.append(job)
+        self._ready.set()
+
+    def _expire(self, job: BroadcastJob):
+        try:
+            job.expired += sum(1 for _ in job._targets)
+        except Exception as e:
+            logger.error(f"Ошибка чтения адресатов рассылки '{job.name}': {e}")
+        job.expired += len(job.deferred)
+        job.deferred.clear()
+        job.exhausted = True
+        logger.warning(f"Рассылка '{job.name}': срок актуальности истёк, не отправлено {job.expired}")
+        self._finish_if_done(job)
+
+    def _finish_if_done(self, job: BroadcastJob):
+        if job.exhausted and not job.deferred and job.in_flight == 0 and not job.done.done():
+            logger.info(
+                f"Рассылка '{job.name}' завершена: успешно {job.success}, ошибок {job.errors}, "
+                f"устарело {job.expired}, пропущено {job.skipped}, дубликатов {job.duplicates}"
+            )
+            job.done.set_result(
+                BroadcastResult(job.success, job.errors, job.expired, job.skipped, job.duplicates)
+            )
+
+    async def _worker(self):
+        while True:
+            item, wait = self._next_target()
+            if item is None:
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job, link = item
+            try:
+                sent = await send_to_group(link, job.text, job.media_type, job.media_file_id, job.deadline)
+            except SlowModeWaitError as e:
+                job.in_flight -= 1
+                self._defer(job, link, e.seconds)
+                continue
+            except DuplicateGroupError as e:
+                # Группа уже получает рассылку под своей основной ссылкой
+                logger.info(f"Пропуск: {e}")
+                job.in_flight -= 1
+                job.duplicates += 1
+                self._finish_if_done(job)
+                continue
+            except Exception as e:
+                logger.error(f"Ошибка отправки в {link}: {e}")
+                sent = False
+            job.in_flight -= 1
+            if sent is None:
+                job.expired += 1
+            elif sent:
+                job.success += 1
+                stats.increment_sent()
+                # Следующее сообщение в этот чат - не раньше интервала медленного режима
+                if link in slow_mode_links:
+                    chat_ready_at[link] = asyncio.get_running_loop().time() + slow_mode_links[link]
             else:
-                errors += 1
-        
-        await callback_query.message.edit_text(
+                job.errors += 1
+                stats.increment_errors()
+            self._finish_if_done(job)
+
+    @property
+    def active_jobs(self) -> int:
+        return len(self._jobs)
+
+broadcast_engine = BroadcastEngine(SEND_WORKERS)
+
+def plan_delivery(targets_count: int, window_seconds: Optional[int] = None) -> Tuple[float, float]:
+    # Пауза между отправками, чтобы равномерно заполнить окно, и ожидаемая
+    # длительность рассылки. Быстрее SEND_INTERVAL плюс время самой
+    # отправки (send_latency) отправлять нельзя.
+    interval = window_seconds / targets_count if window_seconds and targets_count else 0
+    if interval <= SEND_INTERVAL:
+        interval = 0
+    duration = targets_count * max(interval, SEND_INTERVAL + send_latency)
+    return interval, duration
+
+def start_broadcast(targets: Iterable[str], text: str, media_type: str = None,
+                    media_file_id: str = None, name: str = "ручная",
+                    ttl_seconds: Optional[int] = None) -> BroadcastJob:
+    deadline = datetime.now(pytz.utc).timestamp() + ttl_seconds if ttl_seconds else None
+    return broadcast_engine.submit(name, targets, text, media_type, media_file_id, deadline=deadline)
+
+async def report_broadcast(message: types.Message, job: BroadcastJob):
+    # Итог рассылки заменяет сообщение "Начинаю отправку", а если его уже
+    # нельзя изменить - приходит отдельным сообщением
+    try:
+        result = await job.wait()
+        report = (
             f"✅ Отправка завершена!\n\n"
-            f"• Успешно: {success}\n"
-            f"• Ошибок: {errors}",
-            reply_markup=get_main_menu_kb()
+            f"• Успешно: {result.success}\n"
+            f"• Ошибок: {result.errors}"
+        )
+        if result.expired:
+            report += f"\n• Не отправлено по сроку актуальности: {result.expired}"
+        if result.skipped:
+            report += f"\n• Пропущено (нет права писать): {result.skipped}"
+        if result.duplicates:
+            report += f"\n• Пропущено дубликатов: {result.duplicates}"
+        try:
+            await message.edit_text(report, reply_markup=get_main_menu_kb())
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение об отправке: {e}")
+            await bot.send_message(message.chat.id, report, reply_markup=get_main_menu_kb())
+    except Exception as e:
+        logger.error(f"Ошибка в отчёте о рассылке '{job.name}': {e}")
+
+@dp.callback_query(F.data == "confirm_send")
+async def confirm_send(callback_query: types.CallbackQuery):
+    text = db.get_current_text()
+    media_type, media_file_id = db.get_current_media()
+
+    if not (text or media_file_id) or not db.has_groups():
+        await callback_query.answer("❌ Текст или группы не установлены", show_alert=True)
+        return
+
+    # Обработчик не ждёт рассылку: она идёт в BroadcastEngine, а итог
+    # присылает report_broadcast
+    await callback_query.answer()
+    try:
+        await callback_query.message.edit_text("⏳ Начинаю отправку...")
+        job = start_broadcast(
+            (group.link for group in db.iter_groups()),
+            text,
+            media_type,
+            media_file_id,
+            ttl_seconds=BROADCAST_TTL_MINUTES * 60 or None
         )
     except Exception as e:
         logger.error(f"Ошибка в confirm_send: {e}")
-        await callback_query.answer("❌ Ошибка при отправке", show_alert=True)
-    finally:
-        await callback_query.answer()
+        await callback_query.message.edit_text("❌ Ошибка при отправке", reply_markup=get_main_menu_kb())
+        return
+    run_in_background(report_broadcast(callback_query.message, job))
+
+# Идущий пробный прогон: повторное нажатие не запускает второй
+preflight_task: Optional[asyncio.Task] = None
+
+@dp.callback_query(F.data == "preflight")
+async def preflight_send(callback_query: types.CallbackQuery):
+    global preflight_task
+    if not db.has_groups():
+        await callback_query.answer("❌ Группы не установлены", show_alert=True)
+        return
+    if preflight_task is not None and not preflight_task.done():
+        await callback_query.answer("⏳ Проверка уже идёт", show_alert=True)
+        return
+    # Ответ сразу: проверка большого списка идёт дольше, чем живёт колбэк,
+    # поэтому она выполняется в фоне, а не в обработчике
+    await callback_query.answer()
+    preflight_task = run_in_background(report_preflight(callback_query.message))
+
+async def report_preflight(message: types.Message):
+    try:
+        await message.edit_text("⏳ Проверяю группы, ничего не отправляя...")
+        reported = 0
+
+        async def progress(done: int, total: int):
+            nonlocal reported
+            # Не чаще, чем каждые 10% списка: у правки сообщений тоже есть лимиты
+            if done < total and done - reported < max(total // 10, METADATA_BATCH_SIZE):
+                return
+            reported = done
+            try:
+                await message.edit_text(f"⏳ Проверено групп: {done} из {total}")
+            except Exception as e:
+                logger.warning(f"Не удалось обновить ход проверки: {e}")
+
+        report = await preflight(progress)
+        # Чаты в медленном режиме ждут, пока идут остальные: рассылка не
+        # закончится раньше, чем освободится последний из них
+        _, duration = plan_delivery(report.deliverable + report.unknown)
+        duration = max(duration, report.slow_mode_wait)
+        text = (
+            f"🧪 Проверка перед рассылкой:\n\n"
+            f"• Всего групп: {report.total}\n"
+            f"• Можно отправить: {report.deliverable}\n"
+            f"• Нельзя отправить: {report.blocked}\n"
+            f"• Не удалось проверить: {report.unknown}\n"
+            f"• Дубликаты (будут пропущены): {report.duplicates}\n"
+            f"• Запросов к Telegram: {report.checked}\n\n"
+            f"⏳ Ожидаемая длительность рассылки: ~{max(1, round(duration / 60))} мин"
+        )
+        if report.interrupted:
+            text += "\n\n⚠️ Проверка прервана лимитом Telegram, часть групп не проверена"
+        await message.edit_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🚀 Отправить", callback_data="confirm_send")],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="content_menu")]
+            ]))
+    except Exception as e:
+        logger.error(f"Ошибка в preflight_send: {e}")
+        try:
+            await message.edit_text("⚠️ Ошибка при проверке групп", reply_markup=get_content_menu_kb())
+        except Exception as e:
+            logger.warning(f"Не удалось сообщить об ошибке проверки: {e}")
 
 # ======================
 # ОБРАБОТЧИКИ РАСПИСАНИЯ
@@ -999,7 +3044,7 @@ async def set_time_process(message: types.Message, state: FSMContext):
     
     try:
         time_obj = datetime.strptime(message.text, "%H:%M").time()
-        db.set_setting('scheduled_time', message.text)
+        db.set_scheduled_time(time_obj)
         await message.answer(
             f"✅ Время отправки установлено на {message.text}",
             reply_markup=get_scheduler_menu_kb()
@@ -1019,9 +3064,17 @@ async def add_schedule_start(callback_query: types.CallbackQuery, state: FSMCont
     try:
         await callback_query.message.edit_text(
             "Введите время и текст для запланированной отправки в формате:\n\n"
-            "Время (ЧЧ:ММ)\n"
+            "Время (ЧЧ:ММ), дата или правило повтора\n"
             "/\n"
             "Текст сообщения\n\n"
+            "Дата: <code>25.12.2026 10:00</code>, <code>завтра в 10:00</code>, <code>через 3 часа</code>\n"
+            "Окно доставки: <code>09:00-10:30</code> или <code>завтра в 9:00 окно 90</code>\n"
+            "Часовой пояс: <code>10:00 Europe/Berlin</code>, по поясам групп волнами: <code>10:00 местное</code>\n"
+            "Срок актуальности в минутах: <code>10:00 срок 60</code> - не отправленное за час отбрасывается\n"
+            "Правило повтора в формате cron (минуты часы дни месяцы дни_недели):\n"
+            "• <code>0 9 * * 1-5</code> - по будням в 09:00\n"
+            "• <code>0 */3 * * *</code> - каждые 3 часа\n"
+            "• <code>0 9 * * 1#1</code> - в первый понедельник месяца в 09:00\n\n"
             "✏️ Для отмены введите /cancel",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🔙 Назад", callback_data="scheduler_menu")]
@@ -1039,27 +3092,77 @@ async def add_schedule_process(message: types.Message, state: FSMContext):
         return
     
     try:
-        time_part, text = message.text.split("/", 1)
-        time_str = time_part.strip()
+        time_part, text = message.text.split("\n/", 1) if "\n/" in message.text else message.text.split("/", 1)
+        time_str, ttl_seconds = split_ttl(time_part.strip())
         text = text.strip()
         
-        # Проверка формата времени
-        datetime.strptime(time_str, "%H:%M").time()
+        # ЧЧ:ММ - ближайшее наступление времени, затем правило повтора,
+        # затем дата или фраза вроде "завтра в 10:00"
+        bare_time, _, _, local_waves = split_schedule_suffixes(time_str)
+        post = await parse_schedule(time_str, text)
+        if post is None:
+            raise ValueError(f"Не удалось разобрать время: {time_str}")
+        post = post._replace(ttl_seconds=ttl_seconds)
         
-        groups = [g['link'] for g in db.get_groups()]
-        if not groups:
+        # "местное": одна волна на каждый часовой пояс групп
+        if local_waves:
+            waves = db.get_links_by_timezone()
+        else:
+            waves = {post.timezone: [g.link for g in db.iter_groups()]}
+        if not any(waves.values()):
             await message.answer("❌ Нет групп для отправки", reply_markup=get_scheduler_menu_kb())
             return
         
-        db.add_scheduled_post(text, time_str, groups)
+        # Сначала проверяются все волны: ошибка в одной не должна оставить
+        # в расписании часть кампании
+        now = datetime.now(pytz.utc).timestamp()
+        planned = []
+        for timezone, groups in waves.items():
+            wave = post._replace(timezone=timezone)
+            if local_waves and not (post.rule or post.send_time):
+                # Дата разбирается заново в поясе волны
+                wave = await parse_schedule_time(bare_time, text, timezone)
+                if wave is None:
+                    raise ValueError(f"Не удалось разобрать время: {time_str}")
+                wave = wave._replace(
+                    timezone=timezone, window_seconds=post.window_seconds, ttl_seconds=post.ttl_seconds
+                )
+            next_fire_at = compute_next_fire(wave)
+            if not (wave.rule or wave.send_time) and next_fire_at <= now:
+                await message.answer(
+                    "❌ Это время уже прошло",
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="🔙 Назад", callback_data="scheduler_menu")]
+                    ]))
+                return
+            planned.append(wave._replace(text=text, groups=groups, next_fire_at=next_fire_at))
+        
+        lines = []
+        for post_id in db.add_scheduled_posts(planned):
+            wave = db.get_scheduled_post(post_id)
+            scheduler.schedule(wave)
+            
+            # Прогноз окончания с учётом окна и ограничения скорости
+            interval, duration = plan_delivery(len(wave.groups), wave.window_seconds)
+            finish_at = datetime.fromtimestamp(wave.next_fire_at + duration, post_timezone(wave))
+            line = (
+                f"• {describe_schedule(wave)}\n"
+                f"  ⏳ Ожидаемое окончание: {finish_at.strftime('%d.%m %H:%M')} ({len(wave.groups)} групп)"
+            )
+            if wave.window_seconds and duration > wave.window_seconds:
+                line += "\n  ⚠️ Окно слишком короткое для такого числа групп с учётом лимитов"
+            if wave.ttl_seconds and duration > wave.ttl_seconds:
+                line += "\n  ⚠️ Часть групп не успеет получить пост до истечения срока актуальности"
+            lines.append(line)
+        
         await message.answer(
-            f"✅ Запланированная отправка добавлена на {time_str}",
+            "✅ Запланированная отправка добавлена:\n" + "\n".join(lines),
             reply_markup=get_scheduler_menu_kb()
         )
     except ValueError as e:
         await message.answer(
             "❌ Неверный формат. Используйте:\n\n"
-            "Время (ЧЧ:ММ)\n"
+            "Время (ЧЧ:ММ), дата или правило повтора\n"
             "/\n"
             "Текст сообщения",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -1068,64 +3171,90 @@ async def add_schedule_process(message: types.Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.callback_query(F.data == "view_schedule")
-async def view_schedule(callback_query: types.CallbackQuery):
-    posts = db.get_scheduled_posts()
+def render_schedule_page(after_id: int = 0,
+                         before_id: Optional[int] = None) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    posts, more = db.get_scheduled_posts_page(after_id, before_id)
+    if not posts and (after_id or before_id is not None):
+        after_id, before_id = 0, None
+        posts, more = db.get_scheduled_posts_page()
     if not posts:
-        await callback_query.answer("Список запланированных постов пуст", show_alert=True)
-        return
+        return None
+    has_prev, has_next = (more, True) if before_id is not None else (after_id > 0, more)
     
     posts_list = []
     for post in posts:
-        groups = ", ".join(post['groups']) if isinstance(post['groups'], list) else post['groups']
+        # Полный список групп может не поместиться в сообщение
+        groups = ", ".join(post.groups[:3])
+        if len(post.groups) > 3:
+            groups += f" и ещё {len(post.groups) - 3}"
         posts_list.append(
-            f"⏰ {post['send_time']}\n"
-            f"📝 {post['text'][:50]}...\n"
+            f"⏰ {describe_schedule(post)}\n"
+            f"📝 {post.text[:50]}...\n"
             f"👥 Группы: {groups}\n"
-            f"ID: {post['id']}\n"
+            f"ID: {post.id}\n"
         )
     
-    await callback_query.message.edit_text(
-        "📅 Запланированные посты:\n\n" + "\n".join(posts_list),
-        reply_markup=get_scheduler_menu_kb()
-    )
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"spage:p:{posts[0].id}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"spage:n:{posts[-1].id}"))
+    builder = InlineKeyboardBuilder()
+    if nav:
+        builder.row(*nav)
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="scheduler_menu"))
+    return "📅 Запланированные посты:\n\n" + "\n".join(posts_list), builder.as_markup()
+
+@dp.callback_query(F.data == "view_schedule")
+async def view_schedule(callback_query: types.CallbackQuery):
+    page = render_schedule_page()
+    if page is None:
+        await callback_query.answer("Список запланированных постов пуст", show_alert=True)
+        return
+    
+    text, markup = page
+    await callback_query.message.edit_text(text, reply_markup=markup)
+    await callback_query.answer()
+
+@dp.callback_query(F.data.startswith("spage:"))
+async def schedule_page(callback_query: types.CallbackQuery):
+    _, direction, anchor = callback_query.data.split(":")
+    if direction == "p":
+        page = render_schedule_page(before_id=int(anchor))
+    else:
+        page = render_schedule_page(after_id=int(anchor))
+    if page is None:
+        await callback_query.answer("Список запланированных постов пуст", show_alert=True)
+        return
+    
+    text, markup = page
+    await callback_query.message.edit_text(text, reply_markup=markup)
     await callback_query.answer()
 
 @dp.callback_query(F.data == "remove_schedule")
 async def remove_schedule_start(callback_query: types.CallbackQuery, state: FSMContext):
-    posts = db.get_scheduled_posts()
-    if not posts:
+    markup = get_remove_schedule_kb()
+    if markup is None:
         await callback_query.answer("Список запланированных постов пуст", show_alert=True)
         return
     
-    builder = InlineKeyboardBuilder()
-    for post in posts:
-        builder.button(
-            text=f"🗑 {post['send_time']} - {post['text'][:20]}...", 
-            callback_data=f"confirm_remove_schedule_{post['id']}"
-        )
-    
-    builder.adjust(1)
-    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="scheduler_menu"))
-    
     await callback_query.message.edit_text(
         "Выберите запланированную отправку для удаления:",
-        reply_markup=builder.as_markup()
+        reply_markup=markup
     )
     await callback_query.answer()
 
-@dp.callback_query(F.data.startswith("confirm_remove_schedule_"))
+@dp.callback_query(F.data.startswith("ask_remove_schedule_"))
 async def confirm_remove_schedule(callback_query: types.CallbackQuery):
     post_id = int(callback_query.data.split("_")[-1])
-    posts = db.get_scheduled_posts()
-    post = next((p for p in posts if p['id'] == post_id), None)
+    post = db.get_scheduled_post(post_id)
     
     if not post:
         await callback_query.answer("❌ Запланированная отправка не найдена", show_alert=True)
         return
     
     await callback_query.message.edit_text(
-        f"Вы уверены, что хотите удалить запланированную отправку на {post['send_time']}?",
+        f"Вы уверены, что хотите удалить запланированную отправку {describe_schedule(post)}?",
         reply_markup=get_confirmation_kb(f"remove_schedule_{post_id}")
     )
     await callback_query.answer()
@@ -1134,6 +3263,7 @@ async def confirm_remove_schedule(callback_query: types.CallbackQuery):
 async def remove_schedule_process(callback_query: types.CallbackQuery):
     post_id = int(callback_query.data.split("_")[-1])
     db.remove_scheduled_post(post_id)
+    scheduler.unschedule(post_id)
     
     await callback_query.message.edit_text(
         "✅ Запланированная отправка удалена!",
@@ -1148,13 +3278,14 @@ async def remove_schedule_process(callback_query: types.CallbackQuery):
 @dp.callback_query(F.data == "show_stats")
 async def show_stats(callback_query: types.CallbackQuery):
     try:
-        groups_count = len(db.get_groups())
-        templates_count = len(db.get_templates())
-        posts_count = len(db.get_scheduled_posts())
+        groups_count = db.count_groups()
+        templates_count = db.count_templates()
+        posts_count = db.count_scheduled_posts()
+        checked_count, unpostable_count = db.count_group_health()
         
         await callback_query.message.edit_text(
             f"📊 Статистика:\n\n"
-            f"• Групп: {groups_count}\n"
+            f"• Групп: {groups_count} (проверено {checked_count}, недоступно {unpostable_count})\n"
             f"• Шаблонов: {templates_count}\n"
             f"• Запланированных постов: {posts_count}\n"
             f"• Отправлено сообщений: {stats.sent_count}\n"
@@ -1179,6 +3310,7 @@ async def show_help(callback_query: types.CallbackQuery):
             "- '🗑 Удалить' - удалить группу из списка\n"
             "- '🏷 Теги' - назначить теги для групп\n"
             "- '🔍 Фильтр' - фильтровать группы по тегам\n"
+            "- '🌍 Часовой пояс' - задать часовой пояс группам с тегом\n"
             "- '📋 Список' - просмотреть все добавленные группы\n\n"
             
             "2. РАБОТА С КОНТЕНТОМ:\n"
@@ -1193,7 +3325,7 @@ async def show_help(callback_query: types.CallbackQuery):
             "3. НАСТРОЙКА РАСПИСАНИЯ:\n"
             "- В разделе '⏰ Расписание':\n"
             "  * '🕒 Установить время' - задать время для ежедневной рассылки\n"
-            "  * '➕ Добавить' - создать новую запланированную рассылку\n"
+            "  * '➕ Добавить' - создать новую запланированную рассылку (на время, дату или по правилу повтора)\n"
             "  * '🗑 Удалить' - удалить запланированную рассылку\n"
             "  * '📋 Список' - просмотреть все запланированные рассылки\n\n"
             
@@ -1227,33 +3359,473 @@ async def show_help(callback_query: types.CallbackQuery):
 # ПЛАНИРОВЩИК
 # ======================
 
-async def check_scheduled_posts():
-    while True:
+def localize(tz, local: datetime) -> datetime:
+    # Перевод локального времени в aware с учётом перехода на летнее время:
+    # несуществующее время (перевод часов вперёд) сдвигается на величину
+    # перевода, из двух одинаковых (перевод назад) берётся первое
+    try:
+        return tz.localize(local, is_dst=None)
+    except pytz.NonExistentTimeError:
+        return tz.normalize(tz.localize(local, is_dst=False))
+    except pytz.AmbiguousTimeError:
+        return tz.localize(local, is_dst=True)
+
+def post_timezone(post: ScheduledPost):
+    return pytz.timezone(post.timezone or TIMEZONE)
+
+class CronRule:
+    # Правило в формате cron: минуты часы дни_месяца месяцы дни_недели.
+    # Поддерживаются списки, диапазоны и шаги (1-5, */3, 0,30), а также
+    # n-й день недели месяца: 1#1 - первый понедельник.
+    # Дни недели: 0 или 7 - воскресенье, 1 - понедельник.
+    SEARCH_DAYS = 366 * 5
+
+    def __init__(self, text: str):
+        parts = text.split()
+        if len(parts) != 5:
+            raise ValueError(f"Правило должно состоять из 5 полей: {text}")
+        self.text = " ".join(parts)
+        self.minutes = sorted(self._parse_field(parts[0], 0, 59))
+        self.hours = sorted(self._parse_field(parts[1], 0, 23))
+        self.days = self._parse_field(parts[2], 1, 31)
+        self.months = self._parse_field(parts[3], 1, 12)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+        self.nth_weekday = None
+        if '#' in parts[4]:
+            weekday, nth = parts[4].split('#', 1)
+            self.weekdays = {int(weekday) % 7}
+            self.nth_weekday = int(nth)
+            if not 0 <= int(weekday) <= 7 or not 1 <= self.nth_weekday <= 5:
+                raise ValueError(f"Неверный день недели: {parts[4]}")
+        else:
+            self.weekdays = {day % 7 for day in self._parse_field(parts[4], 0, 7)}
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> Set[int]:
+        values = set()
+        for item in field.split(','):
+            value_range, _, step = item.partition('/')
+            step = int(step) if step else 1
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(v) for v in value_range.split('-', 1))
+            else:
+                start = int(value_range)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"Неверное значение поля: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, day) -> bool:
+        if day.month not in self.months:
+            return False
+        weekday_ok = (day.weekday() + 1) % 7 in self.weekdays
+        if self.nth_weekday:
+            weekday_ok = weekday_ok and (day.day - 1) // 7 + 1 == self.nth_weekday
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day.day in self.days
+        # Как в cron: если заданы оба поля, достаточно совпадения любого
+        return day.day in self.days or weekday_ok
+
+    def next_after(self, after: float, tz) -> float:
+        start = datetime.fromtimestamp(after, tz).replace(tzinfo=None, second=0, microsecond=0)
+        start += timedelta(minutes=1)
+        day = start.date()
+        for _ in range(self.SEARCH_DAYS):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        local = datetime.combine(day, time(hour, minute))
+                        if local < start:
+                            continue
+                        fire_at = localize(tz, local).timestamp()
+                        if fire_at > after:
+                            return fire_at
+            day += timedelta(days=1)
+        raise ValueError(f"Правило никогда не срабатывает: {self.text}")
+
+@lru_cache(maxsize=256)
+def parse_rule(text: str) -> CronRule:
+    return CronRule(text)
+
+@lru_cache(maxsize=16)
+def get_date_parser(timezone: str) -> DateDataParser:
+    # Создание парсера дорогое (загрузка языковых данных), поэтому он
+    # один на процесс для каждого часового пояса
+    return DateDataParser(
+        languages=['ru', 'en'],
+        settings={
+            'PREFER_DATES_FROM': 'future',
+            'TIMEZONE': timezone,
+            'RETURN_AS_TIMEZONE_AWARE': True,
+            'TO_TIMEZONE': 'UTC'
+        }
+    )
+
+date_parser_lock = threading.Lock()
+
+def parse_datetime(text: str, timezone: Optional[str] = None) -> Optional[datetime]:
+    # Синхронный и медленный разбор: вызывать через asyncio.to_thread
+    with date_parser_lock:
+        return get_date_parser(timezone or TIMEZONE).get_date_data(text).date_obj
+
+async def parse_datetime_async(text: str, timezone: Optional[str] = None) -> Optional[datetime]:
+    return await asyncio.to_thread(parse_datetime, text, timezone)
+
+def compute_next_fire(post: ScheduledPost, after: Optional[float] = None) -> float:
+    after = after if after is not None else datetime.now(pytz.utc).timestamp()
+    if post.rule:
+        return parse_rule(post.rule).next_after(after, post_timezone(post))
+    if post.send_time:
+        return next_fire_time(
+            post.send_time, datetime.fromtimestamp(after, pytz.utc), post_timezone(post)
+        ).timestamp()
+    # Отправка на конкретную дату: время уже хранится в next_fire_at
+    if post.next_fire_at is None:
+        raise ValueError(f"У запланированной отправки {post.id} нет времени")
+    return post.next_fire_at
+
+WINDOW_RANGE = re.compile(r'^(\d{1,2}:\d{2})\s*[-–—]\s*(\d{1,2}:\d{2})$')
+WINDOW_SUFFIX = re.compile(r'\s+окно\s+(\d+)\s*(?:мин\.?|м)?$', re.IGNORECASE)
+
+# Срок актуальности в конце строки расписания: "срок 60" (минут)
+TTL_SUFFIX = re.compile(r'\s+срок\s+(\d+)\s*(?:мин\.?|м)?$', re.IGNORECASE)
+
+def split_ttl(time_str: str) -> Tuple[str, Optional[int]]:
+    # "<время> срок 60" -> (время, срок актуальности в секундах)
+    match = TTL_SUFFIX.search(time_str)
+    if match:
+        return time_str[:match.start()].strip(), int(match.group(1)) * 60 or None
+    return time_str, None
+
+def split_delivery_window(time_str: str) -> Tuple[str, Optional[int]]:
+    # "09:00-10:30" или "<время> окно 90" -> (время, длительность окна в секундах)
+    match = WINDOW_RANGE.match(time_str)
+    if match:
+        start = datetime.strptime(match.group(1), "%H:%M")
+        end = datetime.strptime(match.group(2), "%H:%M")
+        window = (end - start).seconds  # через полночь тоже корректно
+        return match.group(1), window or None
+    match = WINDOW_SUFFIX.search(time_str)
+    if match:
+        return time_str[:match.start()].strip(), int(match.group(1)) * 60 or None
+    return time_str, None
+
+# Часовой пояс в конце строки расписания: "Europe/Berlin" или "местное"
+LOCAL_TIME_WORD = "местное"
+
+def split_timezone(time_str: str) -> Tuple[str, Optional[str], bool]:
+    # -> (время, часовой пояс, отправлять волнами по поясам групп)
+    head, _, last = time_str.rpartition(' ')
+    if head and last.lower() == LOCAL_TIME_WORD:
+        return head.strip(), None, True
+    if head and last in pytz.all_timezones_set:
+        return head.strip(), last, False
+    return time_str, None, False
+
+def split_schedule_suffixes(time_str: str) -> Tuple[str, Optional[int], Optional[str], bool]:
+    # -> (время, окно, часовой пояс, волнами); окно и пояс пишут в любом порядке
+    time_str, timezone, local_waves = split_timezone(time_str)
+    time_str, window_seconds = split_delivery_window(time_str)
+    if not (timezone or local_waves):
+        time_str, timezone, local_waves = split_timezone(time_str)
+    return time_str, window_seconds, timezone, local_waves
+
+async def parse_schedule(time_str: str, text: str) -> Optional[ScheduledPost]:
+    time_str, window_seconds, timezone, _ = split_schedule_suffixes(time_str)
+    post = await parse_schedule_time(time_str, text, timezone)
+    return post._replace(window_seconds=window_seconds, timezone=timezone) if post else None
+
+async def parse_schedule_time(time_str: str, text: str,
+                              timezone: Optional[str] = None) -> Optional[ScheduledPost]:
+    try:
+        datetime.strptime(time_str, "%H:%M")
+        return ScheduledPost(id=0, text=text, send_time=time_str, groups=[])
+    except ValueError:
+        pass
+    try:
+        return ScheduledPost(id=0, text=text, send_time=None, groups=[], rule=parse_rule(time_str).text)
+    except ValueError:
+        pass
+    fire_at = await parse_datetime_async(time_str, timezone)
+    if fire_at is None:
+        return None
+    return ScheduledPost(id=0, text=text, send_time=None, groups=[], next_fire_at=fire_at.timestamp())
+
+def describe_schedule(post: ScheduledPost) -> str:
+    if post.rule:
+        when = f"🔁 {post.rule}"
+    elif post.send_time:
+        when = post.send_time
+    else:
+        when = "📅"
+    if post.next_fire_at:
+        next_at = datetime.fromtimestamp(post.next_fire_at, post_timezone(post))
+        if post.rule or post.send_time:
+            when += f" (след.: {next_at.strftime('%d.%m %H:%M')})"
+        else:
+            when += f" {next_at.strftime('%d.%m.%Y %H:%M')}"
+    if post.timezone:
+        when += f" [{post.timezone}]"
+    if post.window_seconds:
+        when += f", окно {post.window_seconds // 60} мин"
+    if post.ttl_seconds:
+        when += f", срок {post.ttl_seconds // 60} мин"
+    return when
+
+def next_fire_time(send_time: str, now: Optional[datetime] = None, tz=None) -> datetime:
+    # Ближайшее наступление ЧЧ:ММ в часовом поясе tz (по умолчанию TIMEZONE).
+    # Если эта минута идёт прямо сейчас, отправка выполняется сразу, как и раньше.
+    tz = tz or pytz.timezone(TIMEZONE)
+    local_now = (now or datetime.now(pytz.utc)).astimezone(tz)
+    fire_time = datetime.strptime(send_time, "%H:%M").time()
+    fire_at = localize(tz, datetime.combine(local_now.date(), fire_time))
+    if fire_at + timedelta(minutes=1) <= local_now:
+        fire_at = localize(tz, datetime.combine(local_now.date() + timedelta(days=1), fire_time))
+    return fire_at
+
+class Scheduler:
+    # Не спим дольше этого, чтобы заметить перевод системных часов
+    # и изменения расписания, сделанные другими экземплярами бота
+    MAX_SLEEP = 5
+    # Опоздание, после которого срабатывание считается пропущенным
+    MISSED_AFTER = 60
+    # Виды событий в куче
+    PREWARM = 0
+    FIRE = 1
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, int]] = []
+        # Актуальное время события по (вид, id поста): записи в куче,
+        # не совпадающие с ним, считаются удалёнными и пропускаются
+        self._due: Dict[Tuple[int, int], float] = {}
+        # Уже запущенные подготовки (id поста, время срабатывания): переживают
+        # перезагрузку индекса, чтобы подготовка не запускалась повторно
+        self._prewarmed: Set[Tuple[int, float]] = set()
+        # Идущие подготовки по id поста: отменяются при срабатывании
+        self._prewarm_tasks: Dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._posts_version = None
+
+    def load(self):
+        # Правила здесь не вычисляются: время срабатывания уже лежит в индексе
+        self._heap = []
+        self._due = {}
+        self._posts_version = db.get_change_version('scheduled_posts')
+        posts = db.get_pending_posts()
+        for post in posts:
+            self.schedule(post)
+        logger.info(f"Планировщик: загружено {len(posts)} запланированных отправок")
+
+    def _push(self, kind: int, post_id: int, at: float):
+        if self._due.get((kind, post_id)) == at:
+            return
+        self._due[(kind, post_id)] = at
+        heapq.heappush(self._heap, (at, kind, post_id))
+        self._wakeup.set()
+
+    def schedule(self, post: ScheduledPost):
+        fire_at = post.next_fire_at
+        if fire_at is None:
+            try:
+                fire_at = compute_next_fire(post)
+            except (ValueError, TypeError):
+                logger.error(f"Неверное расписание у запланированной отправки {post.id}: {post.rule or post.send_time}")
+                return
+            db.set_post_next_fire(post.id, fire_at)
+        self._push(self.FIRE, post.id, fire_at)
+        # Подготовка нужна, только если срабатывание ещё впереди и она не запускалась.
+        # Большому списку групп нужно больше времени: адресаты разрешаются
+        # по одному в темпе RESOLVE_INTERVAL
+        if fire_at > datetime.now(pytz.utc).timestamp() and (post.id, fire_at) not in self._prewarmed:
+            lead = max(PREWARM_MINUTES * 60, len(post.groups) * RESOLVE_INTERVAL)
+            self._push(self.PREWARM, post.id, fire_at - lead)
+
+    def unschedule(self, post_id: int):
+        self._prewarmed = {key for key in self._prewarmed if key[0] != post_id}
+        self.cancel_prewarm(post_id)
+        self._due.pop((self.PREWARM, post_id), None)
+        if self._due.pop((self.FIRE, post_id), None) is not None:
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> Optional[Tuple[float, int, int]]:
+        while self._heap:
+            at, kind, post_id = self._heap[0]
+            if self._due.get((kind, post_id)) != at:
+                heapq.heappop(self._heap)
+                continue
+            if at > now:
+                return None
+            heapq.heappop(self._heap)
+            del self._due[(kind, post_id)]
+            return at, kind, post_id
+        return None
+
+    def _next_timeout(self, now: float) -> float:
+        if not self._heap:
+            return self.MAX_SLEEP
+        return min(max(self._heap[0][0] - now, 0), self.MAX_SLEEP)
+
+    async def run(self):
+        self.load()
+        while True:
+            try:
+                due = self._pop_due(datetime.now(pytz.utc).timestamp())
+                if due is not None:
+                    at, kind, post_id = due
+                    if kind == self.PREWARM:
+                        self.start_prewarm(post_id)
+                    else:
+                        await self.fire(at, post_id)
+                    continue
+                self._wakeup.clear()
+                timeout = self._next_timeout(datetime.now(pytz.utc).timestamp())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                # Посты добавлены или изменены (в том числе другим экземпляром):
+                # перечитываем индекс. Прочие записи в базу сюда не относятся.
+                if db.get_change_version('scheduled_posts') != self._posts_version:
+                    self.load()
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике: {e}")
+                await asyncio.sleep(1)
+
+    def start_prewarm(self, post_id: int):
+        post = db.get_scheduled_post(post_id)
+        if post and (post.id, post.next_fire_at) not in self._prewarmed:
+            self._prewarmed.add((post.id, post.next_fire_at))
+            self.cancel_prewarm(post.id)
+            # Подготовка идёт в фоне и не задерживает другие срабатывания
+            task = asyncio.create_task(prewarm_post(post))
+            self._prewarm_tasks[post.id] = task
+            task.add_done_callback(lambda done: self._forget_prewarm(post.id, done))
+
+    def _forget_prewarm(self, post_id: int, task: asyncio.Task):
+        if self._prewarm_tasks.get(post_id) is task:
+            del self._prewarm_tasks[post_id]
+
+    def cancel_prewarm(self, post_id: int):
+        # Недоделанная подготовка не должна разрешать ссылки параллельно с рассылкой
+        task = self._prewarm_tasks.pop(post_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            logger.info(f"Подготовка поста {post_id} остановлена")
+
+    def catch_up_decision(self, post: ScheduledPost, fire_at: float, now: float) -> bool:
+        # Решение по пропущенному срабатыванию; каждое решение пишется в лог.
+        # Для повторяющихся постов все пропуски сводятся к последнему.
+        missed_runs = 1
+        if post.rule:
+            rule = parse_rule(post.rule)
+            tz = post_timezone(post)
+            while missed_runs < 1000:
+                following = rule.next_after(fire_at, tz)
+                if following > now:
+                    break
+                fire_at = following
+                missed_runs += 1
+        lateness = now - fire_at
+        if CATCHUP_POLICY == "skip":
+            send = False
+        elif CATCHUP_POLICY == "coalesce":
+            send = True
+        else:
+            send = lateness <= CATCHUP_GRACE_MINUTES * 60
+        logger.warning(
+            f"Пропущено срабатываний поста {post.id}: {missed_runs}, "
+            f"последнее запланировано на {datetime.fromtimestamp(fire_at, pytz.utc).isoformat()}, "
+            f"опоздание {int(lateness)} с, последняя отправка "
+            f"{datetime.fromtimestamp(post.last_fired_at, pytz.utc).isoformat() if post.last_fired_at else 'нет'}, "
+            f"политика {CATCHUP_POLICY}: {'отправляем' if send else 'пропускаем'}"
+        )
+        return send
+
+    async def fire(self, fire_at: float, post_id: int):
+        self._prewarmed.discard((post_id, fire_at))
+        self.cancel_prewarm(post_id)
+        post = db.get_scheduled_post(post_id)
+        if not post:
+            return
+        now = datetime.now(pytz.utc).timestamp()
+        # Следующее срабатывание считается сразу, до отправки
+        next_fire_at = compute_next_fire(post, max(now, fire_at)) if post.rule else None
+        send = now - fire_at <= self.MISSED_AFTER or self.catch_up_decision(post, fire_at, now)
+        if not db.claim_post_fire(post.id, fire_at, next_fire_at, now if send else None):
+            logger.info(f"Срабатывание поста {post.id} уже обработано другим экземпляром")
+            return
+        if next_fire_at is not None:
+            self.schedule(post._replace(next_fire_at=next_fire_at))
+        if not send:
+            return
+        # Отправка идёт отдельным заданием: планировщик сразу ждёт следующий пост
+        logger.info(f"Начинаю запланированную отправку {post.id} в {len(post.groups)} групп")
+        interval, duration = plan_delivery(len(post.groups), post.window_seconds)
+        if post.window_seconds:
+            logger.info(
+                f"Пост {post.id}: окно {post.window_seconds // 60} мин, "
+                f"пауза {interval:.1f} с, ожидаемая длительность {int(duration // 60)} мин"
+            )
+        # Срок актуальности отсчитывается от планового времени, а не от фактического
+        deadline = fire_at + post.ttl_seconds if post.ttl_seconds else None
+        broadcast_engine.submit(
+            f"пост {post.id}",
+            post.groups,
+            post.text,
+            post.media_type,
+            post.media_file_id,
+            interval,
+            deadline
+        )
+
+scheduler = Scheduler()
+
+class LeaderLease:
+    # Аренда в таблице leases с продлением: задача work работает только у
+    # владельца аренды. Если владелец упал, аренда истекает через LEASE_TTL
+    # и её забирает другой экземпляр; при остановке аренда освобождается сразу.
+
+    def __init__(self, name: str, work, ttl: float = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._work = work
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def run(self):
         try:
-            now = datetime.now(pytz.timezone(TIMEZONE)).strftime("%H:%M")
-            posts = db.get_scheduled_posts()
-            for post in posts:
-                if post['send_time'] == now:
-                    logger.info(f"Начинаю запланированную отправку в {len(post['groups'])} групп")
-                    success = 0
-                    errors = 0
-                    for group in post['groups']:
-                        if await send_to_group(
-                            group,
-                            post['text'],
-                            post.get('media_type'),
-                            post.get('media_file_id')
-                        ):
-                            success += 1
-                        else:
-                            errors += 1
-                    logger.info(f"Запланированная отправка завершена: успешно {success}, ошибок {errors}")
-                    if post.get('one_time', True):
-                        db.deactivate_scheduled_post(post['id'])
-            await asyncio.sleep(60)
-        except Exception as e:
-            logger.error(f"Ошибка в check_scheduled_posts: {e}")
-            await asyncio.sleep(60)
+            while True:
+                try:
+                    held = db.acquire_lease(self.name, INSTANCE_ID, self.ttl)
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка продления аренды {self.name}: {e}")
+                    held = False
+                if held and not self.is_leader:
+                    logger.info(f"Экземпляр {INSTANCE_ID} стал лидером: {self.name}")
+                    self._task = asyncio.create_task(self._work())
+                elif not held and self._task is not None:
+                    logger.warning(f"Экземпляр {INSTANCE_ID} потерял аренду: {self.name}")
+                    self._task.cancel()
+                    self._task = None
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if self._task is not None:
+                self._task.cancel()
+                db.release_lease(self.name, INSTANCE_ID)
+
+scheduler_lease = LeaderLease("scheduler", scheduler.run)
+metadata_lease = LeaderLease("metadata", metadata_refresher.run)
 
 # ======================
 # ЗАПУСК БОТА
@@ -1272,33 +3844,86 @@ async def on_shutdown():
         logger.error(f"Ошибка при отправке уведомления: {e}")
 
 @dp.errors()
-async def errors_handler(update: types.Update, exception: Exception):
-    if "message is not modified" not in str(exception):
-        logger.error(f"Ошибка при обработке {update}: {exception}")
+async def errors_handler(event: types.ErrorEvent):
+    if "message is not modified" not in str(event.exception):
+        logger.error(f"Ошибка при обработке {event.update}: {event.exception}")
+    return True
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({
+        "status": "ok",
+        "instance": INSTANCE_ID,
+        "scheduler_leader": scheduler_lease.is_leader,
+        "active_broadcasts": broadcast_engine.active_jobs,
+    })
+
+async def start_web_app(webhook: bool) -> web.AppRunner:
+    # Веб-сервер с /health; в режиме webhook на WEBHOOK_PATH принимаются
+    # обновления, запросы без верного секрета отклоняются с кодом 401
+    app = web.Application()
+    app.router.add_get("/health", health)
+    if webhook:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
+    logger.info(f"Веб-сервер слушает {WEB_HOST}:{WEB_PORT}")
+    return runner
+
+async def enable_webhook() -> bool:
+    if not WEBHOOK_URL:
+        logger.warning("BOT_MODE=webhook, но WEBHOOK_URL не задан - работаю через polling")
+        return False
+    try:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    except Exception as e:
+        logger.error(f"Не удалось установить webhook, работаю через polling: {e}")
+        return False
+    logger.info(f"Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
     return True
 
 async def main():
     global client
+    runner = None
     try:
         client = await create_client_with_proxy(API_ID, API_HASH)
         await client.start(phone=PHONE_NUMBER)
         logger.info("Telegram клиент запущен")
 
         # Запуск фоновых задач
-        asyncio.create_task(check_scheduled_posts())
-
-        logger.info("Бот запущен")
-        await dp.start_polling(
-            bot,
-            polling_timeout=30,
-            relax=0.1,
-            allowed_updates=dp.resolve_used_update_types(),
-            on_startup=on_startup,
-            on_shutdown=on_shutdown
-        )
+        asyncio.create_task(scheduler_lease.run())
+        asyncio.create_task(metadata_lease.run())
+        asyncio.create_task(watch_table_changes())
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
+
+        if BOT_MODE == "webhook" and await enable_webhook():
+            runner = await start_web_app(webhook=True)
+            logger.info("Бот запущен (webhook)")
+            await asyncio.Event().wait()
+        else:
+            # /health нужен и при polling, если хостинг ждёт открытый порт
+            if os.getenv("PORT"):
+                runner = await start_web_app(webhook=False)
+            # getUpdates не работает, пока установлен webhook
+            await bot.delete_webhook()
+            logger.info("Бот запущен (polling)")
+            await dp.start_polling(
+                bot,
+                polling_timeout=30,
+                relax=0.1,
+                allowed_updates=dp.resolve_used_update_types()
+            )
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
+        if runner:
+            await runner.cleanup()
         if client:
             await client.disconnect()
         await bot.session.close()